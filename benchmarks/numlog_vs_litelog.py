@@ -0,0 +1,33 @@
+'''
+Transitive closure of random graphs on the numpy and sqlite backends.
+python benchmarks/numlog_vs_litelog.py
+'''
+import random
+import time
+from snakelog.common import *
+from snakelog.litelog import Solver
+from snakelog.numlog import NumpySolver
+
+
+def transitive_closure(s, edges):
+    edge = s.Relation("edge", Sort.NUMBER, Sort.NUMBER)
+    path = s.Relation("path", Sort.NUMBER, Sort.NUMBER)
+    x, y, z = Vars("x y z")
+    for a, b in edges:
+        s.add(edge(a, b))
+    s.add(path(x, y) <= edge(x, y))
+    s.add(path(x, z) <= edge(x, y) & path(y, z))
+    start = time.perf_counter()
+    s.run()
+    elapsed = time.perf_counter() - start
+    s.cur.execute("SELECT * FROM path")
+    return elapsed, len(s.cur.fetchall())
+
+
+if __name__ == "__main__":
+    random.seed(0)
+    for n in [100, 300, 1000]:
+        edges = [(random.randrange(n), random.randrange(n)) for _ in range(n)]
+        for name, solver in [("litelog", Solver), ("numlog", NumpySolver)]:
+            elapsed, size = transitive_closure(solver(), edges)
+            print(f"{name:8} nodes={n:5} path={size:7} {elapsed:.3f}s")
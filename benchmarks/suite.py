@@ -0,0 +1,250 @@
+'''
+Benchmark suite over the snakelog backends.
+python -m benchmarks.suite --size small --json results.json
+
+Every (workload, backend) pair runs in a fresh process, so peak memory
+(max resident set size of the process and of the binaries it spawned) is
+per run. Load time covers declaring relations, adding facts and rules,
+fixpoint time covers run(). Souffle and egglog are skipped when their
+binary is not found.
+'''
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import platform
+import queue
+import random
+import resource
+import shutil
+import subprocess
+import time
+from datetime import datetime, timezone
+from snakelog.common import *
+
+N = Sort.NUMBER
+
+
+def chain(s, n):
+    '''Transitive closure of a path of n nodes'''
+    edge = s.Relation("edge", N, N)
+    path = s.Relation("path", N, N)
+    x, y, z = Vars("x y z")
+    s.add(path(x, y) <= edge(x, y))
+    s.add(path(x, z) <= edge(x, y) & path(y, z))
+    return {"edge": [(i, i + 1) for i in range(n)]}, ["path"]
+
+
+def grid(s, n):
+    '''Transitive closure of an n by n grid with edges right and down'''
+    edge = s.Relation("edge", N, N)
+    path = s.Relation("path", N, N)
+    x, y, z = Vars("x y z")
+    s.add(path(x, y) <= edge(x, y))
+    s.add(path(x, z) <= edge(x, y) & path(y, z))
+    edges = [(i * n + j, i * n + j + 1) for i in range(n) for j in range(n - 1)]
+    edges += [(i * n + j, (i + 1) * n + j) for i in range(n - 1) for j in range(n)]
+    return {"edge": edges}, ["path"]
+
+
+def random_graph(s, n):
+    '''Transitive closure of a random graph with n nodes and n edges'''
+    rand = random.Random(n)
+    edge = s.Relation("edge", N, N)
+    path = s.Relation("path", N, N)
+    x, y, z = Vars("x y z")
+    s.add(path(x, y) <= edge(x, y))
+    s.add(path(x, z) <= path(x, y) & path(y, z))
+    return {"edge": sorted({(rand.randrange(n), rand.randrange(n)) for _ in range(n)})}, ["path"]
+
+
+def same_generation(s, n):
+    '''Same generation on a random tree of n nodes'''
+    rand = random.Random(n)
+    parent = s.Relation("parent", N, N)
+    sg = s.Relation("sg", N, N)
+    x, y, p, q = Vars("x y p q")
+    s.add(sg(x, y) <= parent(x, p) & parent(y, p))
+    s.add(sg(x, y) <= parent(x, p) & sg(p, q) & parent(y, q))
+    return {"parent": [(i, rand.randrange(i)) for i in range(1, n)]}, ["sg"]
+
+
+def points_to(s, n):
+    '''Andersen style points-to analysis of a random program with n variables'''
+    rand = random.Random(n)
+    alloc = s.Relation("alloc", N, N)
+    assign = s.Relation("assign", N, N)
+    load = s.Relation("load", N, N, N)
+    store = s.Relation("store", N, N, N)
+    pt = s.Relation("pt", N, N)
+    hpt = s.Relation("hpt", N, N, N)
+    a, b, f, o1, o2 = Vars("a b f o1 o2")
+    s.add(pt(a, o1) <= alloc(a, o1))
+    s.add(pt(a, o1) <= assign(a, b) & pt(b, o1))
+    s.add(hpt(o1, f, o2) <= store(a, f, b) & pt(a, o1) & pt(b, o2))
+    s.add(pt(a, o2) <= load(a, b, f) & pt(b, o1) & hpt(o1, f, o2))
+
+    def var():
+        return rand.randrange(n)
+    facts = {
+        "alloc": [(var(), i) for i in range(n // 4)],
+        "assign": [(var(), var()) for _ in range(n)],
+        "load": [(var(), var(), rand.randrange(4)) for _ in range(n // 4)],
+        "store": [(var(), rand.randrange(4), var()) for _ in range(n // 4)],
+    }
+    return {name: sorted(set(rows)) for name, rows in facts.items()}, ["pt", "hpt"]
+
+
+def negation(s, n):
+    '''Stratified negation: unreachable nodes and non edges of a random graph with n nodes'''
+    rand = random.Random(n)
+    node = s.Relation("node", N)
+    edge = s.Relation("edge", N, N)
+    reach = s.Relation("reach", N)
+    unreach = s.Relation("unreach", N)
+    nonedge = s.Relation("nonedge", N, N)
+    both = s.Relation("both", N, N)
+    x, y = Vars("x y")
+    s.add(reach(0) <= node(0))
+    s.add(reach(y) <= reach(x) & edge(x, y))
+    s.add(unreach(x) <= node(x) & Not(reach(x)))
+    s.add(nonedge(x, y) <= node(x) & node(y) & Not(edge(x, y)))
+    s.add(both(x, y) <= unreach(x) & nonedge(x, y) & Not(unreach(y)))
+    edges = {(rand.randrange(n), rand.randrange(n)) for _ in range(n // 2)}
+    return {"node": [(i,) for i in range(n)], "edge": sorted(edges)}, ["reach", "unreach", "nonedge", "both"]
+
+
+# name: (workload, sizes per scale, uses negation)
+WORKLOADS = {
+    "chain": (chain, {"small": 200, "medium": 1000, "large": 3000}, False),
+    "grid": (grid, {"small": 10, "medium": 25, "large": 50}, False),
+    "random": (random_graph, {"small": 300, "medium": 1500, "large": 5000}, False),
+    "same_generation": (same_generation, {"small": 300, "medium": 2000, "large": 10000}, False),
+    "points_to": (points_to, {"small": 400, "medium": 4000, "large": 40000}, False),
+    "negation": (negation, {"small": 200, "medium": 800, "large": 2000}, True),
+}
+
+
+def make_solver(backend):
+    if backend == "litelog":
+        from snakelog.litelog import Solver
+        return Solver()
+    elif backend == "numlog":
+        from snakelog.numlog import NumpySolver
+        return NumpySolver()
+    elif backend == "souffle":
+        from snakelog.souffle import SouffleSolver
+        return SouffleSolver()
+    elif backend == "egglog":
+        from snakelog.egglog import EgglogSolver
+        return EgglogSolver()
+    else:
+        raise Exception(f"Unknown backend {backend}")
+
+
+def available(backend):
+    if backend == "souffle":
+        return shutil.which("souffle") is not None
+    elif backend == "egglog":
+        from snakelog import egglog
+        return shutil.which(egglog.execname) is not None
+    return True
+
+
+def supports(backend, negation):
+    # the souffle and egglog compilers only handle positive atoms
+    return not negation or backend in ["litelog", "numlog"]
+
+
+def measure(backend, workload, n, queue):
+    '''Runs one benchmark in a child process and puts its record on queue'''
+    fun = WORKLOADS[workload][0]
+    # keep module imports out of the load time
+    make_solver(backend)
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        s = make_solver(backend)
+        facts, outputs = fun(s, n)
+        for name, rows in facts.items():
+            if hasattr(s, "load"):
+                s.load(name, rows)
+            else:
+                for row in rows:
+                    s.add(Atom(name, row))
+        loaded = time.perf_counter()
+        s.run()
+        done = time.perf_counter()
+        tuples = 0
+        for name in outputs:
+            s.cur.execute(f"SELECT * FROM {name}")
+            tuples += len(s.cur.fetchall())
+    fixpoint = done - loaded
+    # ru_maxrss is in kilobytes on linux
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    queue.put({"workload": workload, "backend": backend, "size": n,
+               "facts": sum([len(rows) for rows in facts.values()]), "tuples": tuples,
+               "load_time": loaded - start, "fixpoint_time": fixpoint,
+               "peak_memory_kb": peak,
+               "tuples_per_second": tuples / fixpoint if fixpoint > 0 else None})
+
+
+def run_one(backend, workload, n, timeout):
+    ctx = multiprocessing.get_context("spawn")
+    results = ctx.Queue()
+    proc = ctx.Process(target=measure, args=(backend, workload, n, results))
+    proc.start()
+    try:
+        res = results.get(timeout=timeout)
+    except queue.Empty:
+        res = {"workload": workload, "backend": backend, "size": n,
+               "error": "timeout" if proc.is_alive() else f"exit code {proc.exitcode}"}
+    proc.kill()
+    proc.join()
+    return res
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", choices=["small", "medium", "large"], default="small")
+    parser.add_argument("--backends", default="litelog,numlog,souffle,egglog",
+                        help="comma separated backends")
+    parser.add_argument("--workloads", default=",".join(WORKLOADS),
+                        help="comma separated workloads")
+    parser.add_argument("--timeout", type=float, default=600,
+                        help="seconds per benchmark")
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args(argv)
+    results = []
+    for workload in args.workloads.split(","):
+        _, sizes, negation = WORKLOADS[workload]
+        for backend in args.backends.split(","):
+            if not available(backend) or not supports(backend, negation):
+                continue
+            res = run_one(backend, workload, sizes[args.size], args.timeout)
+            results.append(res)
+            if "error" in res:
+                print(f"{workload:16} {backend:8} {res['error']}")
+            else:
+                print(f"{workload:16} {backend:8} tuples={res['tuples']:9} load={res['load_time']:.3f}s "
+                      f"fixpoint={res['fixpoint_time']:.3f}s peak={res['peak_memory_kb'] // 1024}MB")
+    report = {"date": datetime.now(timezone.utc).isoformat(), "commit": git_commit(),
+              "python": platform.python_version(), "platform": platform.platform(),
+              "size": args.size, "results": results}
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+    return report
+
+
+if __name__ == "__main__":
+    main()
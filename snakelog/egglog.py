@@ -2,6 +2,11 @@
 import subprocess
 import sqlite3
 import tempfile
+import select
+import os
+import re
+import time
+from collections import defaultdict
 from .common import *
 import sexpdata
 I64 = "i64"
@@ -31,10 +36,123 @@ class EgglogException(Exception):
     pass
 
 
+def parse_rows(lines):
+    '''Groups printed rows (name arg ...) by table name'''
+    rows = defaultdict(list)
+    for line in lines:
+        try:
+            data = sexpdata.loads(line)
+        except:
+            print(f"WARNING Egglog stdout {line} is not sexp")
+            continue
+        rows[data[0].value()].append(tuple(data[1:]))
+    return rows
+
+
+class EgglogSession():
+    '''
+    Long lived egglog process reading commands from a pipe, one per line.
+    Every batch of commands ends by setting and printing the snakelog_sync
+    function to a fresh counter, whose output line marks the end of the
+    output of the batch. A batch fails after timeout seconds without it,
+    unless it is sent with bounded=False as (run N) batches are, which may
+    take as long as saturation does.
+    stderr goes to a temporary file, and is printed after every batch.
+    '''
+
+    def __init__(self, execname=execname, timeout=60):
+        self.timeout = timeout
+        self.stderr = tempfile.TemporaryFile()
+        self.stderr_read = 0
+        self.proc = subprocess.Popen([execname], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                     stderr=self.stderr, text=True, bufsize=1)
+        self.counter = 0
+        # output read from the pipe but not yet split into lines
+        self.buffer = b""
+        self.send("(function snakelog_sync () i64 :merge new)")
+
+    def errors(self):
+        '''stderr written since the previous call'''
+        # pread leaves the file offset, shared with the process, alone
+        data = b""
+        while True:
+            chunk = os.pread(self.stderr.fileno(), 1 << 16, self.stderr_read + len(data))
+            if len(chunk) == 0:
+                break
+            data += chunk
+        self.stderr_read += len(data)
+        return data.decode(errors="replace")
+
+    def send(self, *cmds, bounded=True):
+        '''Runs commands and returns the output lines they printed'''
+        if self.proc.poll() is not None:
+            raise EgglogException(
+                f"egglog exited with {self.proc.returncode} {self.errors()}")
+        self.counter += 1
+        # the row of snakelog_sync may print as (snakelog_sync N) or (snakelog_sync) -> N
+        sync = re.compile(rf"\(snakelog_sync\b.*\b{self.counter}\)?$")
+        cmds = list(cmds) + [f"(set (snakelog_sync) {self.counter})", "(print snakelog_sync 1)"]
+        assert all(["\n" not in cmd for cmd in cmds])
+        self.proc.stdin.write("\n".join(cmds) + "\n")
+        self.proc.stdin.flush()
+        deadline = None if self.timeout is None or not bounded else time.time() + self.timeout
+        lines = []
+        fd = self.proc.stdout.fileno()
+        while True:
+            if b"\n" not in self.buffer:
+                # raw reads, so select does not miss output buffered by python
+                if deadline is not None:
+                    ready, _, _ = select.select(
+                        [fd], [], [], max(0, deadline - time.time()))
+                    if len(ready) == 0:
+                        self.close()
+                        raise EgglogException(
+                            f"egglog timed out after {self.timeout}s, output {lines} {self.errors()}")
+                data = os.read(fd, 1 << 16)
+                if len(data) == 0:
+                    raise EgglogException(
+                        f"egglog exited with {self.proc.wait()} {self.errors()}")
+                self.buffer += data
+                continue
+            line, self.buffer = self.buffer.split(b"\n", 1)
+            line = line.decode().strip()
+            if sync.match(line):
+                errors = self.errors()
+                if errors != "":
+                    print(errors)
+                if "error" in errors.lower():
+                    raise EgglogException(f"egglog failed on {cmds}: {errors}")
+                return lines
+            if line != "":
+                lines.append(line)
+
+    def close(self):
+        if self.proc.poll() is None:
+            self.proc.stdin.close()
+            self.proc.kill()
+            self.proc.wait()
+        self.stderr.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
 class EgglogSolver(BaseSolver):
-    def __init__(self, db=":memory:", execname=execname):
+    def __init__(self, db=":memory:", execname=execname, persistent=False, timeout=60):
+        '''
+        persistent=True keeps one EgglogSession over all runs, sending it only
+        the declarations, rules and facts added since the previous run.
+        timeout bounds every command batch sent to the session other than the
+        (run N) commands, in seconds.
+        '''
         self.execname = execname
-        self.options = {}
+        self.options = {"persistent": persistent, "timeout": timeout}
+        self.session = None
+        # number of sorts, relations, functions and rules already sent to the session
+        self.sent = (0, 0, 0, 0)
         self.rules = []
         self.rels = []
         self.funs = []
@@ -80,27 +198,51 @@ class EgglogSolver(BaseSolver):
             return f"{rel_str(head)}"
         else:
             body = " ".join(map(rel_str, body))
-            return f"(rule ({body})\n\t({rel_str(head)}))"
+            return f"(rule ({body}) ({rel_str(head)}))"
 
-    def run(self):
+    def declarations(self, sorts, rels, funs):
         stmts = []
-        for name in self.sorts:
+        for name in sorts:
             stmts.append(f"(define-datatype {name})")
-        for name, types in self.rels:
+        for name, types in rels:
             args = " ".join(
                 [f"{conv_type(typ)}" for typ in types])
             stmts.append(f"(relation {name} ({args}))")
-        for name, types in self.funs:
+        for name, types in funs:
             args = " ".join(
                 [f"{conv_type(typ)}" for typ in types])
             stmts.append(f"(function {name} ({args}))")
+        return stmts
+
+    def store(self, rows):
+        '''Bulk inserts rows grouped by table'''
+        for name, data in rows.items():
+            if len(data) == 0:
+                continue
+            args = ", ".join("?" * len(data[0]))
+            self.cur.executemany(
+                f"INSERT OR IGNORE INTO {name} VALUES ({args});", data)
 
+    def run(self, iterations=10, timeout=None, outputs=None):
+        '''
+        Runs egglog for at most iterations iterations (None runs to saturation)
+        and copies the tables named in outputs, by default all, into sqlite.
+        With persistent=True a timeout in seconds runs one iteration at a time until
+        it is exceeded or an iteration leaves the table sizes unchanged.
+        '''
+        if outputs is None:
+            outputs = [name for name, _ in self.rels] + \
+                [name for name, _ in self.funs]
+        if iterations is None:
+            # egglog stops early once saturated
+            iterations = 1000000000
+        if self.options["persistent"]:
+            return self.run_session(iterations, timeout, outputs)
+        stmts = self.declarations(self.sorts, self.rels, self.funs)
         for head, body in self.rules:
             stmts.append(self.compile(head, body))
-        stmts.append("(run 10)")
-        for name, types in self.rels:
-            stmts.append(f"(print {name} 1000000)")
-        for name, types in self.funs:
+        stmts.append(f"(run {iterations})")
+        for name in outputs:
             stmts.append(f"(print {name} 1000000)")
         print(stmts)
         with tempfile.TemporaryDirectory() as tmpdirname:
@@ -108,17 +250,48 @@ class EgglogSolver(BaseSolver):
                 fp.writelines([stmt.encode() + b"\n" for stmt in stmts])
                 fp.flush()
                 res = subprocess.run(
-                    [self.execname, fp.name], capture_output=True)
-
-                err = res.stderr.decode()
-                print(err)
-                for line in res.stdout.decode().split(sep="\n"):
-                    print(line)
-                    try:
-                        data = sexpdata.loads(line)
-                    except:
-                        print(f"WARNING Egglog stdout {line} is not sexp")
-                        continue
-                    args = ", ".join("?" * (len(data) - 1))
-                    self.cur.executemany(
-                        f"INSERT OR IGNORE INTO {data[0].value()} VALUES ({args});", [tuple(data[1:])])
+                    [self.execname, fp.name], capture_output=True, timeout=timeout)
+                print(res.stderr.decode())
+                self.store(parse_rows(res.stdout.decode().splitlines()))
+
+    def run_session(self, iterations, timeout, outputs):
+        if self.session is None:
+            self.session = EgglogSession(
+                self.execname, timeout=self.options["timeout"])
+        nsorts, nrels, nfuns, nrules = self.sent
+        stmts = self.declarations(
+            self.sorts[nsorts:], self.rels[nrels:], self.funs[nfuns:])
+        stmts += [self.compile(head, body) for head, body in self.rules[nrules:]]
+        self.sent = (len(self.sorts), len(self.rels),
+                     len(self.funs), len(self.rules))
+        self.session.send(*stmts)
+        if timeout is None:
+            self.session.send(f"(run {iterations})", bounded=False)
+        else:
+            deadline = time.time() + timeout
+            sizes = self.sizes()
+            while iterations > 0 and time.time() < deadline:
+                self.session.send("(run 1)", bounded=False)
+                iterations -= 1
+                sizes, previous = self.sizes(), sizes
+                if sizes == previous:
+                    break
+        lines = self.session.send(
+            *[f"(print {name} 1000000)" for name in outputs])
+        self.store(parse_rows(lines))
+
+    def sizes(self):
+        '''Number of rows of every relation and function in the session'''
+        res = []
+        for name in [name for name, _ in self.rels] + [name for name, _ in self.funs]:
+            numbers = re.findall(r"\d+", " ".join(self.session.send(f"(print-size {name})")))
+            if len(numbers) > 0:
+                res.append(int(numbers[-1]))
+            else:
+                res.append(len(self.session.send(f"(print {name} 1000000000)")))
+        return res
+
+    def close(self):
+        if self.session is not None:
+            self.session.close()
+            self.session = None
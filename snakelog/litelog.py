@@ -1,12 +1,19 @@
 import json
-from typing import Any, List
+from typing import Any, List, Tuple
 import sqlite3
 from dataclasses import dataclass
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from copy import copy
 import networkx as nx
 import time
 import re
+import csv
+import array
+from itertools import islice
+import threading
+import tempfile
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from .common import *
 
 
@@ -20,7 +27,14 @@ INTEGER = "INTEGER"
 TEXT = "TEXT"
 REAL = "REAL"
 BLOB = "BLOB"
-JSON = "TEXT"
+# TEXT affinity, but kept apart from TEXT so interning leaves JSON columns alone
+JSON = "JSON_TEXT"
+# Declared type of interned symbol columns, see Solver(interning=True).
+# It has INTEGER affinity and is decoded by a converter under PARSE_DECLTYPES
+SYMBOL = "SYMBOL_INTEGER"
+# Declared type of hash consed term columns, holding ids of the term table.
+# They are decoded to compact JSON text when read
+TERM = "TERM_INTEGER"
 
 '''keyword is prepended to avoid name collision with user given names'''
 keyword = "litelog"
@@ -39,6 +53,48 @@ def new(name):
     return f"{keyword}_new_{name}"
 
 
+def added(name):
+    '''Tuples added to a relation during an incremental run'''
+    return f"{keyword}_added_{name}"
+
+
+def edb(name):
+    '''Loaded facts of a relation that rules also derive'''
+    return f"{keyword}_edb_{name}"
+
+
+def request(name):
+    '''Temporary table of the facts to explain in a provenance query'''
+    return f"{keyword}_request_{name}"
+
+
+def symbols():
+    '''Table mirroring the symbol table in the database'''
+    return f"{keyword}_symbols"
+
+
+def terms():
+    '''Tables mirroring the term table in the database'''
+    return f"{keyword}_terms"
+
+
+def term_args():
+    return f"{keyword}_term_args"
+
+
+def adorned_name(name, adornment):
+    '''Relations of the magic sets rewrite, see Solver.magic_rules'''
+    return f"{keyword}_demand_{name}_{adornment}"
+
+
+def magic_name(name, adornment):
+    return f"{keyword}_magic_{name}_{adornment}"
+
+
+def match_columns(t1, t2, arity):
+    return " AND ".join([f"{t1}.x{n} = {t2}.x{n}" for n in range(arity)])
+
+
 def validate(name):
     '''Validates valid identifiers'''
     return re.fullmatch("[_a-zA-Z][_a-zA-Z0-9]*", name) != None
@@ -53,6 +109,123 @@ def conv_type(typ):
         return typ
 
 
+'''
+Process wide symbol table. Ids are shared by all solvers so that the global
+converter can decode SYMBOL columns of any connection.
+'''
+symbol_ids = {}
+symbol_names = []
+symbol_lock = threading.Lock()
+
+
+def intern_symbol(x):
+    id_ = symbol_ids.get(x)
+    if id_ is None:
+        with symbol_lock:
+            id_ = symbol_ids.get(x)
+            if id_ is None:
+                id_ = len(symbol_names)
+                symbol_names.append(x)
+                symbol_ids[x] = id_
+    return id_
+
+
+sqlite3.register_converter(SYMBOL, lambda b: symbol_names[int(b)])
+
+
+@dataclass(frozen=True, eq=False)
+class Node:
+    '''
+    Term pattern in a TERM column. Leaves have functor "const" and hold a constant
+    in value, dicts and lists have functors "dict:<keys as json>" and "list:<length>".
+    Solver.add_rule converts the dict, list and constant arguments of TERM columns.
+    '''
+    functor: str
+    args: tuple = ()
+    value: Any = None
+
+
+def to_node(x):
+    if isinstance(x, (Var, SQL, Node)):
+        return x
+    elif isinstance(x, dict):
+        return Node("dict:" + json.dumps(list(x.keys())), tuple([to_node(v) for v in x.values()]))
+    elif isinstance(x, list):
+        return Node(f"list:{len(x)}", tuple([to_node(v) for v in x]))
+    else:
+        return Node("const", value=x)
+
+
+'''
+Process wide hash consed term table. Every distinct (functor, value, children)
+gets an integer id, so equal terms are equal integers and subterms are shared.
+Terms are never freed, so it holds every distinct term created in the process.
+'''
+term_ids = {}
+# id -> (functor, value, child ids)
+term_nodes = []
+term_lock = threading.Lock()
+
+
+def intern_term(functor, value=None, children=()):
+    key = (functor, type(value).__name__, value, children)
+    id_ = term_ids.get(key)
+    if id_ is None:
+        with term_lock:
+            id_ = term_ids.get(key)
+            if id_ is None:
+                id_ = len(term_nodes)
+                term_nodes.append((functor, value, children))
+                term_ids[key] = id_
+    return id_
+
+
+def term_of(x):
+    '''Id of a ground Node or python value (dicts, lists and constants)'''
+    x = to_node(x)
+    if x.functor == "const":
+        return intern_term("const", x.value)
+    return intern_term(x.functor, None, tuple([term_of(arg) for arg in x.args]))
+
+
+def ground(x):
+    if isinstance(x, Node):
+        return all([ground(arg) for arg in x.args])
+    return not isinstance(x, (Var, SQL))
+
+
+def term_value(id_):
+    '''Python value of a term. Iterative, so deep terms do not hit the recursion limit.'''
+    values = {}
+    stack = [id_]
+    while len(stack) > 0:
+        n = stack[-1]
+        functor, value, children = term_nodes[n]
+        missing = [c for c in children if c not in values]
+        if len(missing) > 0:
+            stack += missing
+            continue
+        stack.pop()
+        if functor == "const":
+            values[n] = value
+        elif functor.startswith("dict:"):
+            values[n] = dict(zip(json.loads(functor[5:]), [values[c] for c in children]))
+        else:
+            values[n] = [values[c] for c in children]
+    return values[id_]
+
+
+def term_json(id_):
+    return json.dumps(term_value(int(id_)), separators=(',', ':'))
+
+
+sqlite3.register_converter(TERM, term_json)
+
+
+def sql_string(x):
+    return "'" + x.replace("'", "''") + "'"
+
+
 class VarMap():
     '''
     Union Find Dict https://www.philipzucker.com/union-find-dict/
@@ -84,7 +257,7 @@ class VarMap():
         if varmap[x1] == []:
             varmap[x1] = y1
         elif varmap[y1] == []:
-            varmap[y1] == x1
+            varmap[y1] = x1
         else:
             temp = varmap[x1]
             varmap[x1] = y1
@@ -107,7 +280,12 @@ class ConstantMap(dict):
 
 
 def construct(arg, varmap, constants):
-    if isinstance(arg, SQL):
+    if isinstance(arg, Node):
+        if ground(arg):
+            return constants.add_constant(term_of(arg))
+        children = ", ".join([construct(v, varmap, constants) for v in arg.args])
+        return f"{keyword}_term({sql_string(arg.functor)}, {children})"
+    elif isinstance(arg, SQL):
         formatvarmap = varmap.formatmap()
         return arg.expr.format(**formatvarmap)
     elif isinstance(arg, dict):
@@ -120,6 +298,16 @@ def construct(arg, varmap, constants):
         return constants.add_constant(arg)
 
 
+def comparable(x):
+    '''
+    JSON path expressions are compared as TEXT. A TEXT affinity column equated
+    to a bare json_extract converts it first, which keeps SQLite from probing an
+    expression index on it, and the cast gives the same values.
+    '''
+    x = str(x)
+    return f"CAST({x} AS TEXT)" if x.startswith("json_extract(") else x
+
+
 def compile_query(body: List[Formula]):
     # map from variables to columns where they appear
     # We use WHERE clauses and let SQL do the heavy lifting
@@ -149,10 +337,20 @@ def compile_query(body: List[Formula]):
             wheres.append(f"json_array_length({x}) = {len(pat)}")
             for n, v in enumerate(pat):
                 match_(f"json_extract({x},'$[{n}]')", v)
+        elif isinstance(pat, Node) and ground(pat):
+            id_ = constants.add_constant(term_of(pat))
+            wheres.append(f"{id_} = {x}")
+        elif isinstance(pat, Node):
+            # integer lookups in the term table
+            wheres.append(
+                f"(SELECT functor FROM {terms()} WHERE id = {x}) = {sql_string(pat.functor)}")
+            for n, v in enumerate(pat.args):
+                match_(
+                    f"(SELECT child FROM {term_args()} WHERE id = {x} AND n = {n})", v)
         else:
             # Assume constant can be handled by SQLite adapter
             id_ = constants.add_constant(pat)
-            wheres.append(f"{id_} = {x}")
+            wheres.append(f"{id_} = {comparable(x)}")
 
     for rel in body:
         # Every relation in the body creates a new FROM term bounded to
@@ -196,7 +394,7 @@ def compile_query(body: List[Formula]):
     for argset in varmap.values():
         for arg in argset:
             if argset[0] != arg:
-                wheres.append(f"{argset[0]} = {arg}")
+                wheres.append(f"{comparable(argset[0])} = {comparable(arg)}")
 
     '''
     for v, argset in varmap.items():
@@ -213,8 +411,17 @@ def compile_query(body: List[Formula]):
     return varmap, constants, froms, wheres
 
 
-def compile(head: Atom, body: List[Formula], naive=False):
+def compile(head: Atom, body: List[Formula], naive=False, delta_index=None, cross_join=False):
+    '''
+    Compiles a rule into SQL inserting into the new_ table of the head.
+    naive=True gives a single statement over the base tables.
+    Otherwise one semi-naive variant is emitted per body atom, with that atom
+    replaced by its delta_ table. delta_index restricts the output to the
+    variant of that atom. cross_join=True joins with CROSS JOIN, which makes
+    SQLite keep the body order.
+    '''
     assert isinstance(head, Atom)
+    join = " CROSS JOIN " if cross_join else ", "
 
     varmap, constants, froms, wheres = compile_query(body)
     if len(wheres) > 0:
@@ -227,40 +434,446 @@ def compile(head: Atom, body: List[Formula], naive=False):
     if naive:
         if len(froms) > 0:
             froms = " FROM " + \
-                ", ".join([f"{table} AS {row}" for table, row in froms])
+                join.join([f"{table} AS {row}" for table, row in froms])
         else:
             froms = ""
         return f"INSERT OR IGNORE INTO {new(head.name)} SELECT DISTINCT {selects}{froms}{wheres}", constants
     else:
         stmts = []
         for n in range(len(froms)):
+            if delta_index is not None and n != delta_index:
+                continue
             froms1 = copy(froms)
             froms1[n] = delta(froms1[n][0]), froms1[n][1]
-            froms1 = ", ".join([f"{table} AS {row}" for table, row in froms1])
+            froms1 = join.join([f"{table} AS {row}" for table, row in froms1])
             stmts.append(
                 (f"INSERT OR IGNORE INTO {new(head.name)} SELECT DISTINCT {selects} FROM {froms1}{wheres} ", constants))
         return stmts
 
 
+def binding_patterns(body: List[Formula]):
+    '''
+    For every positive atom of body returns (relation name, bound columns).
+    A column is bound if the WHERE clause of compile_query equates it to a
+    constant or to an expression over another atom, i.e. it can be looked up
+    by index when the atom is joined after the others.
+    '''
+    varmap, constants, froms, wheres = compile_query(body)
+    bound = {row: set() for _, row in froms}
+    for argset in varmap.values():
+        for arg in argset:
+            m = re.fullmatch(r"(\w+)\.x(\d+)", str(arg))
+            if m != None and m[1] in bound and any([f"{m[1]}." not in str(other) for other in argset]):
+                bound[m[1]].add(int(m[2]))
+    for where in wheres:
+        m = re.fullmatch(r":\d+ = (\w+)\.x(\d+)", where)
+        if m != None and m[1] in bound:
+            bound[m[1]].add(int(m[2]))
+    return [(table, frozenset(bound[row])) for table, row in froms]
+
+
+def json_paths(body: List[Formula]):
+    '''
+    JSON path expressions of body that the WHERE clause of compile_query equates to
+    something, as (relation name, expression over the bare columns) pairs, e.g.
+    ("nats", "CAST(json_extract(x0,'$.succ') AS TEXT)") for nats(succ(x)). An
+    expression index on them turns the destructuring of dict and list patterns
+    into index lookups.
+    '''
+    varmap, constants, froms, wheres = compile_query(body)
+    tables = {row: table for table, row in froms}
+    exprs = [comparable(arg) for argset in varmap.values() if len(argset) > 1 for arg in argset]
+    exprs += [m[1] for m in [re.fullmatch(r":\d+ = (.*)", where) for where in wheres] if m != None]
+    res = []
+    for expr in exprs:
+        rows = set(re.findall(r"(\w+)\.x\d+", expr))
+        if expr.startswith("CAST(json_extract(") and len(rows) == 1:
+            row = rows.pop()
+            if row in tables and (tables[row], expr.replace(f"{row}.", "")) not in res:
+                res.append((tables[row], expr.replace(f"{row}.", "")))
+    return res
+
+
+def choose_indexes(patterns, arity):
+    '''
+    Picks a small set of index column orders such that every pattern in patterns
+    is a prefix of one of them or of the primary key (x0, ..., xn).
+    Patterns are visited smallest first and indexes are extended when possible,
+    so {1} and {1,2} share the index (x1, x2).
+    '''
+    indexes = []
+    for cols in sorted(set(patterns), key=lambda cols: (len(cols), sorted(cols))):
+        if len(cols) == 0 or len(cols) == arity or cols == set(range(len(cols))):
+            continue
+        if any([set(index[:len(cols)]) == cols for index in indexes]):
+            continue
+        for n, index in enumerate(indexes):
+            if set(index) < cols:
+                indexes[n] = index + tuple(sorted(cols - set(index)))
+                break
+        else:
+            indexes.append(tuple(sorted(cols)))
+    return indexes
+
+
+def index_name(table, cols):
+    return f"{keyword}_idx_{table}_{'_'.join(map(str, cols))}"
+
+
+def pattern_vars(pat):
+    if isinstance(pat, Var):
+        return [pat]
+    elif isinstance(pat, Node):
+        return [v for x in pat.args for v in pattern_vars(x)]
+    elif isinstance(pat, dict):
+        return [v for x in pat.values() for v in pattern_vars(x)]
+    elif isinstance(pat, list):
+        return [v for x in pat for v in pattern_vars(x)]
+    else:
+        return []
+
+
+def join_order(body: List[Formula], first, estimate):
+    '''
+    Greedy join order of the positive atoms of body, as a list of atom indices.
+    Starts at atom first if it is not None, then repeatedly picks the atom with the
+    smallest estimate(n, bound columns) given the variables bound so far.
+    '''
+    atoms = [rel for rel in body if isinstance(rel, Atom)]
+    # variables made equal or bound to constants by Eq constraints.
+    # Keyed by name since Var.__eq__ builds an Eq
+    rep = {}
+
+    def find(x):
+        x = x.name
+        while x in rep:
+            x = rep[x]
+        return x
+    for rel in body:
+        if isinstance(rel, Eq) and isinstance(rel.lhs, Var) and isinstance(rel.rhs, Var):
+            if find(rel.lhs) != find(rel.rhs):
+                rep[find(rel.lhs)] = find(rel.rhs)
+    bound = set()
+    for rel in body:
+        if isinstance(rel, Eq) and isinstance(rel.lhs, Var) != isinstance(rel.rhs, Var):
+            bound.add(find(rel.lhs if isinstance(rel.lhs, Var) else rel.rhs))
+
+    def bound_cols(atom):
+        return frozenset([n for n, arg in enumerate(atom.args)
+                          if not isinstance(arg, (Var, dict, list, Node)) or (isinstance(arg, Var) and find(arg) in bound)])
+    order = []
+    remaining = list(range(len(atoms)))
+    while len(remaining) > 0:
+        if len(order) == 0 and first is not None:
+            n = first
+        else:
+            n = min(remaining, key=lambda n: estimate(
+                n, bound_cols(atoms[n])))
+        order.append(n)
+        remaining.remove(n)
+        bound.update([find(v) for arg in atoms[n].args for v in pattern_vars(arg)])
+    return order
+
+
+def reorder(body: List[Formula], order):
+    '''Permutes the atoms of body into order, leaving other formulas in place'''
+    atoms = [rel for rel in body if isinstance(rel, Atom)]
+    atoms = iter([atoms[n] for n in order])
+    return [next(atoms) if isinstance(rel, Atom) else rel for rel in body]
+
+
+def rule_key(head: Atom, body: List[Formula]):
+    '''Structural key of a rule. Rules that print the same compile to the same SQL.'''
+    return repr((head, body))
+
+
+@dataclass(frozen=True)
+class Param:
+    '''Placeholder of the n-th constant argument of a rule, see parametrize'''
+    n: int
+
+
+def parametrize(head: Atom, body: List[Formula]):
+    '''
+    The rule with the constant arguments of its atoms replaced by Params, and the
+    list of those constants. Cached plans are keyed on the parametrized rule and
+    bound to the constants of each rule, so rules with constants that print the
+    same never share parameters and the cache keeps no constants alive.
+    Constants of Eq are inlined into the SQL text and stay in the key.
+    '''
+    consts = []
+
+    def param(x):
+        if isinstance(x, (Var, SQL, dict, list, Node)):
+            return x
+        consts.append(x)
+        return Param(len(consts) - 1)
+
+    def atom(rel):
+        return Atom(rel.name, tuple([param(arg) for arg in rel.args]))
+    body = [atom(rel) if isinstance(rel, Atom) else
+            Not(atom(rel.val)) if isinstance(rel, Not) and isinstance(rel.val, Atom) else rel
+            for rel in body]
+    return atom(head), body, consts
+
+
+def bind(params, consts):
+    '''Parameters of a cached statement with the Params replaced by consts'''
+    return ConstantMap({k: consts[v.n] if isinstance(v, Param) else v for k, v in params.items()})
+
+
+@dataclass
+class RulePlan:
+    '''
+    Compiled SQL of a rule.
+    variants holds one (delta relation name, statement, parameters) entry per body atom.
+    '''
+    naive: Tuple[str, ConstantMap]
+    variants: List[Tuple[str, str, ConstantMap]]
+    # (relation name, bound columns) per body atom, see binding_patterns
+    bindings: List[Tuple[str, frozenset]]
+    # (relation name, expression) per JSON path of the body, see json_paths
+    expressions: List[Tuple[str, str]]
+
+    def bind(self, consts):
+        return RulePlan((self.naive[0], bind(self.naive[1], consts)),
+                        [(name, stmt, bind(params, consts)) for name, stmt, params in self.variants],
+                        self.bindings, self.expressions)
+
+
+def plan(head: Atom, body: List[Formula]):
+    names = [rel.name for rel in body if isinstance(rel, Atom)]
+    variants = [(name, stmt, params)
+                for name, (stmt, params) in zip(names, compile(head, body))]
+    return RulePlan(compile(head, body, naive=True), variants, binding_patterns(body), json_paths(body))
+
+
+class PlanCache():
+    '''
+    LRU cache of RulePlan keyed on rule_key.
+    The module level plan_cache is shared by all solvers, so rerunning the same
+    rules on a fresh Solver skips recompilation.
+    '''
+
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self.plans = OrderedDict()
+        # parallel strata share the cache
+        self.lock = threading.Lock()
+
+    def lookup(self, key, make, stats):
+        with self.lock:
+            res = self.plans.get(key)
+            if res is None:
+                stats["plan_cache_misses"] += 1
+                res = make()
+                self.plans[key] = res
+                if len(self.plans) > self.maxsize:
+                    self.plans.popitem(last=False)
+            else:
+                stats["plan_cache_hits"] += 1
+                self.plans.move_to_end(key)
+            return res
+
+    def get(self, head, body, stats=None):
+        if stats is None:
+            stats = defaultdict(int)
+        head, body, consts = parametrize(head, body)
+        return self.lookup(rule_key(head, body), lambda: plan(head, body), stats).bind(consts)
+
+    def get_ordered(self, head, body, order, naive=False, stats=None):
+        '''
+        Statement of the rule with body atoms joined in order by CROSS JOIN.
+        Unless naive, the first atom in order is read from its delta_ table.
+        '''
+        if stats is None:
+            stats = defaultdict(int)
+        head, body, consts = parametrize(head, body)
+
+        def make():
+            body1 = reorder(body, order)
+            if naive:
+                return compile(head, body1, naive=True, cross_join=True)
+            else:
+                return compile(head, body1, delta_index=0, cross_join=True)[0]
+        stmt, params = self.lookup((rule_key(head, body), tuple(order), naive), make, stats)
+        return stmt, bind(params, consts)
+
+    def clear(self):
+        self.plans.clear()
+
+
+plan_cache = PlanCache()
+
+
+class Profiler():
+    '''
+    Time and row counts of a Solver run, see Solver(profile=True).
+    Rule entries are keyed by (stratum, rule, variant), where variant is the index
+    of the body atom read from delta_ or None for a naive pass. rows counts the
+    tuples a statement inserted into new_, and a stratum counts as duplicates the
+    derived or loaded rows that were already in the base table.
+    '''
+
+    def __init__(self):
+        # parallel strata record concurrently
+        self.lock = threading.Lock()
+        self.rules = defaultdict(lambda: [0.0, 0, 0])
+        self.strata = defaultdict(lambda: [0.0, 0, 0, 0])
+        # last (statement, parameters) per rule entry, for EXPLAIN QUERY PLAN
+        self.statements = {}
+
+    def rule(self, strata, head, body, variant, stmt, params, elapsed, rows):
+        key = (",".join(sorted(strata)), f"{head} :- {body}", variant)
+        with self.lock:
+            entry = self.rules[key]
+            entry[0] += elapsed
+            entry[1] += rows
+            entry[2] += 1
+            self.statements[key] = stmt, params
+
+    def iteration(self, strata):
+        with self.lock:
+            self.strata[",".join(sorted(strata))][1] += 1
+
+    def stratum(self, strata, elapsed, loaded, added):
+        with self.lock:
+            entry = self.strata[",".join(sorted(strata))]
+            entry[0] += elapsed
+            entry[2] += loaded
+            entry[3] += added
+
+    def to_json(self):
+        '''Plain dict of the profile, with rule entries sorted by decreasing time'''
+        with self.lock:
+            rules = [{"stratum": stratum, "rule": rule, "variant": variant,
+                      "time": t, "rows": rows, "calls": calls}
+                     for (stratum, rule, variant), (t, rows, calls) in self.rules.items()]
+            rows = defaultdict(int)
+            for entry in rules:
+                rows[entry["stratum"]] += entry["rows"]
+            strata = [{"stratum": stratum, "time": t, "iterations": iterations, "rows": rows[stratum],
+                       "loaded": loaded, "added": added, "duplicates": rows[stratum] + loaded - added}
+                      for stratum, (t, iterations, loaded, added) in self.strata.items()]
+        rules.sort(key=lambda entry: -entry["time"])
+        return {"rules": rules, "strata": strata}
+
+    def folded(self):
+        '''
+        Profile in the folded stack format of flamegraph.pl, one
+        stratum;rule;variant line per entry weighted by microseconds.
+        '''
+        lines = []
+        for entry in self.to_json()["rules"]:
+            variant = "naive" if entry["variant"] is None else f"delta{entry['variant']}"
+            frames = [entry["stratum"], entry["rule"], variant]
+            lines.append(";".join([frame.replace(";", ",") for frame in frames]) +
+                         f" {round(entry['time'] * 1e6)}")
+        return "\n".join(lines)
+
+    def clear(self):
+        with self.lock:
+            self.rules.clear()
+            self.strata.clear()
+            self.statements.clear()
+
+
+class Connection(sqlite3.Connection):
+    '''
+    Connection of a Solver. adapters maps Python classes to functions encoding
+    their values for this connection only, e.g. into a store registered by
+    z3lite.enable_z3. Solver.encode applies them before the process wide
+    sqlite3 adapters would.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.adapters = {}
+
+
 class Solver(BaseSolver):
     '''
     SQLite based datalog solver
     '''
 
-    def __init__(self, debug=False, database=":memory:"):
+    def __init__(self, debug=False, database=":memory:", plan_cache=plan_cache, cached_statements=1024, auto_index=True,
+                 join_planner=False, incremental=False, provenance=False, workers=1, on_connect=None,
+                 interning=False, profile=False):
         self.con = sqlite3.connect(
-            database=database, detect_types=sqlite3.PARSE_DECLTYPES)
+            database=database, detect_types=sqlite3.PARSE_DECLTYPES, cached_statements=cached_statements, factory=Connection)
         self.cur = self.con.cursor()
+        self.database = database
+        self.cached_statements = cached_statements
+        # Independent strata run on separate connections, see run_parallel
+        self.workers = workers
+        # called with every worker connection, e.g. to register functions
+        self.on_connect = on_connect
+        if workers > 1:
+            assert database != ":memory:", "Parallel strata need a database file"
+            self.cur.execute("PRAGMA journal_mode=WAL")
         self.rules = []
         self.rels = {}
         self.debug = debug
         self.stats = defaultdict(int)
+        self.plan_cache = plan_cache
+        # ground facts from add() waiting to be bulk loaded
+        self.facts = defaultdict(list)
+        self.auto_index = auto_index
+        # secondary index column orders per relation
+        self.indexes = defaultdict(list)
+        # indexed JSON path expressions per relation
+        self.expression_indexes = defaultdict(list)
+        self.join_planner = join_planner
+        # row counts of the base tables, kept up to date by run()
+        self.sizes = defaultdict(int)
+        # relations whose base table analyze() counted, after which sizes is maintained
+        self.counted = set()
+        # relation sizes and index names at the last ANALYZE
+        self.analyzed = None
+        # (index columns, average rows per key prefix, rows) per relation from sqlite_stat1
+        self.selectivity = defaultdict(list)
+        self.incremental = incremental
+        # rule_key of the rules evaluated by a previous incremental run
+        self.evaluated = set()
+        # relations with tuples loaded into new_ since the last run
+        self.staged = set()
+        # relations derived by rules whose loaded facts are recorded in edb_
+        self.edb_tracked = set()
+        self.timestamp = 0
+        self.tracing = provenance
+        # relations with an old_ table recording when each tuple was derived
+        self.traced = set()
+        # compiled provenance queries per rule and memoized proofs
+        self.provenance_queries = {}
+        self.proofs = {False: {}, True: {}}
+        # TEXT columns hold SYMBOL ids of the process wide symbol table
+        self.interning = interning
+        # number of symbols copied into the symbols table
+        self.synced_symbols = 0
+        # number of terms copied into the term tables, created with the first TERM column
+        self.synced_terms = None
+        # per rule and per stratum statistics, independent of debug
+        self.profiler = Profiler() if profile else None
+        # lattice join function of the last column per lattice relation
+        self.lattices = {}
+        # relations evaluated by a run(outputs=...), None for all
+        self.slice = None
+        self.slice_report = None
+        if self.execute(f"SELECT * FROM sqlite_master WHERE type = 'table' AND name = '{symbols()}'").fetchone() is not None:
+            self.load_symbols()
+        elif interning:
+            self.cur.execute(
+                f"CREATE TABLE IF NOT EXISTS {symbols()}(id INTEGER PRIMARY KEY, name TEXT NOT NULL)")
+        if self.execute(f"SELECT * FROM sqlite_master WHERE type = 'table' AND name = '{terms()}'").fetchone() is not None:
+            self.load_terms()
 
     def execute(self, stmt, *args):
 
         if self.debug:
             print(stmt, args)
             start_time = time.time()
+        if len(args) > 0:
+            args = (self.encode_params(args[0]),) + args[1:]
         try:
             self.cur.execute(stmt, *args)
         except BaseException as e:
@@ -269,84 +882,706 @@ class Solver(BaseSolver):
         if self.debug:
             end_time = time.time()
             self.stats[stmt] += end_time - start_time
+        return self.cur
+
+    def adapt(self, x):
+        '''x encoded by the first adapter of the connection matching its class'''
+        for cls, f in self.con.adapters.items():
+            if isinstance(x, cls):
+                return f(x)
+        return x
+
+    def encode(self, name, row):
+        '''
+        Replaces the symbols and terms of a row of relation name by their ids,
+        and applies the adapters of the connection.
+        '''
+        types = self.rels[name]
+        if len(self.con.adapters) > 0:
+            row = [self.adapt(x) for x in row]
+        if not self.interning and TERM not in types:
+            return tuple(row)
+        return tuple([intern_symbol(x) if typ == SYMBOL else term_of(x) if typ == TERM else x
+                      for x, typ in zip(row, types)])
+
+    def encode_params(self, params):
+        '''
+        Applies the adapters of the connection to the parameters of a statement.
+        Strings compared to SYMBOL columns were interned by symbol_patterns.
+        '''
+        if len(self.con.adapters) > 0:
+            if isinstance(params, dict):
+                params = type(params)({k: self.adapt(v) for k, v in params.items()})
+            else:
+                params = tuple([self.adapt(x) for x in params])
+        return params
+
+    def sync_symbols(self):
+        '''Copies the symbols interned since the last call into the symbols table'''
+        n = len(symbol_names)
+        if self.interning and n > self.synced_symbols:
+            self.cur.executemany(f"INSERT OR IGNORE INTO {symbols()} VALUES (?, ?)",
+                                 [(id_, symbol_names[id_]) for id_ in range(self.synced_symbols, n)])
+            self.synced_symbols = n
+
+    def load_symbols(self):
+        '''
+        Interns the symbols of the symbols table of a reopened database. Ids that
+        this process already gave to other symbols are remapped in every SYMBOL
+        column, first to negative values so primary keys never collide midway.
+        '''
+        remap = [(id_, intern_symbol(name)) for id_, name in
+                 self.execute(f"SELECT id, name FROM {symbols()}").fetchall()]
+        remap = [(old_id, new_id) for old_id, new_id in remap if old_id != new_id]
+        if len(remap) > 0:
+            self.remap_ids(SYMBOL, remap)
+            self.execute(f"DELETE FROM {symbols()}")
+            self.cur.executemany(f"INSERT INTO {symbols()} VALUES (?, ?)", list(enumerate(symbol_names)))
+            self.con.commit()
+            self.synced_symbols = len(symbol_names)
+
+    def remap_ids(self, typ, remap):
+        '''
+        Replaces the (old, new) id pairs of remap in every column of declared type
+        typ, first by negative values so primary keys never collide midway.
+        '''
+        self.execute(
+            f"CREATE TEMP TABLE {keyword}_remap(old INTEGER PRIMARY KEY, new INTEGER NOT NULL)")
+        self.cur.executemany(
+            f"INSERT INTO {keyword}_remap VALUES (?, ?)", [(-1 - old_id, new_id) for old_id, new_id in remap])
+        tables = [name for name, in self.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table'").fetchall()]
+        for table in tables:
+            for _, col, coltyp, *_ in self.execute(f"PRAGMA table_info({table})").fetchall():
+                if coltyp == typ:
+                    self.execute(
+                        f"UPDATE {table} SET {col} = -1 - {col} WHERE {col} IN (SELECT -1 - old FROM {keyword}_remap)")
+                    self.execute(
+                        f"UPDATE {table} SET {col} = (SELECT new FROM {keyword}_remap WHERE old = {col}) WHERE {col} < 0")
+        self.execute(f"DROP TABLE {keyword}_remap")
+
+    def enable_terms(self):
+        '''
+        Creates the term tables of the database, which pattern matching on TERM
+        columns joins against and which load_terms reads back on reopening, and
+        the term constructor function. The tables mirror the whole process wide
+        term table: they grow by one row per distinct term created in the process
+        by any solver, and rows are never deleted.
+        '''
+        assert self.workers == 1, "TERM columns are not supported with parallel strata"
+        self.execute(
+            f"CREATE TABLE IF NOT EXISTS {terms()}(id INTEGER PRIMARY KEY, functor TEXT NOT NULL, value TEXT)")
+        self.execute(
+            f"CREATE TABLE IF NOT EXISTS {term_args()}(id INTEGER, n INTEGER, child INTEGER, PRIMARY KEY (id, n)) WITHOUT ROWID")
+        self.con.create_function(f"{keyword}_term", -1, lambda functor, *children: intern_term(functor, None, children),
+                                 deterministic=True)
+        self.con.create_function(f"{keyword}_term_json", 1, term_json, deterministic=True)
+        self.synced_terms = 0
+        self.sync_terms()
+
+    def sync_terms(self):
+        '''Copies the terms created since the last call into the term tables'''
+        n = len(term_nodes)
+        if self.synced_terms is None or n <= self.synced_terms:
+            return
+        new_terms = range(self.synced_terms, n)
+        # constants are stored as JSON so load_terms gets back values of the same type
+        self.cur.executemany(f"INSERT INTO {terms()} VALUES (?, ?, ?)",
+                             [(id_, term_nodes[id_][0], json.dumps(term_nodes[id_][1]) if term_nodes[id_][0] == "const" else None)
+                              for id_ in new_terms])
+        self.cur.executemany(f"INSERT INTO {term_args()} VALUES (?, ?, ?)",
+                             [(id_, k, child) for id_ in new_terms for k, child in enumerate(term_nodes[id_][2])])
+        self.synced_terms = n
+
+    def load_terms(self):
+        '''
+        Interns the terms of the term tables of a reopened database. Children have
+        smaller ids than their parents, so terms are interned in id order. Ids that
+        differ in this process are remapped in every TERM column, and the term
+        tables are rewritten from the process term table.
+        '''
+        children = defaultdict(list)
+        for id_, _, child in self.execute(f"SELECT id, n, child FROM {term_args()} ORDER BY id, n").fetchall():
+            children[id_].append(child)
+        ids = {}
+        for id_, functor, value in self.execute(f"SELECT id, functor, value FROM {terms()} ORDER BY id").fetchall():
+            ids[id_] = intern_term(functor, None if value is None else json.loads(value),
+                                   tuple([ids[child] for child in children[id_]]))
+        remap = [(old_id, new_id) for old_id, new_id in ids.items() if old_id != new_id]
+        if len(remap) > 0:
+            self.remap_ids(TERM, remap)
+        self.execute(f"DELETE FROM {terms()}")
+        self.execute(f"DELETE FROM {term_args()}")
+        self.enable_terms()
+        self.con.commit()
+
+    def term_patterns(self, rel):
+        '''Converts the arguments of the TERM columns of an atom to Node patterns'''
+        if isinstance(rel, Not):
+            return Not(self.term_patterns(rel.val))
+        # without term tables there is no TERM column
+        if not isinstance(rel, Atom) or self.synced_terms is None:
+            return rel
+        types = self.column_types(rel.name)
+        if TERM not in types:
+            return rel
+        return Atom(rel.name, tuple([to_node(arg) if typ == TERM else arg
+                                     for arg, typ in zip(rel.args, types)]))
+
+    def column_types(self, name):
+        '''Declared column types of relation name, also for the tables of a reopened database'''
+        if name in self.rels:
+            return self.rels[name]
+        if not validate(name):
+            return []
+        return [typ for _, col, typ, *_ in self.execute(f"PRAGMA table_info({name})").fetchall()]
+
+    def symbol_patterns(self, head, body):
+        '''
+        Interns the string constants of the SYMBOL columns of a rule, or of a query
+        body when head is None, and those equated to variables of SYMBOL columns.
+        SQL expressions over these variables would see their ids, so they are
+        refused, as are SQL expressions written to SYMBOL columns.
+        '''
+        if not self.interning:
+            return head, body
+        atoms = [rel.val if isinstance(rel, Not) else rel for rel in body if isinstance(rel, (Atom, Not))]
+        atoms += [head] if head is not None else []
+        symbols = {arg.name for rel in atoms
+                   for arg, typ in zip(rel.args, self.column_types(rel.name)) if typ == SYMBOL and isinstance(arg, Var)}
+        eqs = [{rel.lhs.name, rel.rhs.name} for rel in body
+               if isinstance(rel, Eq) and isinstance(rel.lhs, Var) and isinstance(rel.rhs, Var)]
+        while any([len(names & symbols) == 1 for names in eqs]):
+            for names in eqs:
+                if len(names & symbols) == 1:
+                    symbols |= names
+
+        def check_sql(expr):
+            used = sorted(set(re.findall(r"\{(\w+)\}", expr)) & symbols)
+            if len(used) > 0:
+                raise Exception(
+                    f"SQL expression {expr} uses the SYMBOL variables {used}, which hold interned ids")
+
+        def atom(rel):
+            if isinstance(rel, Not):
+                return Not(atom(rel.val))
+            types = self.column_types(rel.name)
+            if len(types) != len(rel.args):
+                return rel
+            args = []
+            for n, (arg, typ) in enumerate(zip(rel.args, types)):
+                if isinstance(arg, SQL):
+                    if typ == SYMBOL:
+                        raise Exception(
+                            f"SQL expression {arg.expr} can not be written to the SYMBOL column {n} of {rel.name}")
+                    check_sql(arg.expr)
+                elif typ == SYMBOL and isinstance(arg, str):
+                    arg = intern_symbol(arg)
+                args.append(arg)
+            return Atom(rel.name, tuple(args))
+
+        def formula(rel):
+            if isinstance(rel, (Atom, Not)):
+                return atom(rel)
+            if isinstance(rel, str):
+                check_sql(rel)
+            elif isinstance(rel, Eq):
+                lhs, rhs = rel.lhs, rel.rhs
+                if isinstance(lhs, Var) and lhs.name in symbols and isinstance(rhs, str):
+                    rhs = intern_symbol(rhs)
+                if isinstance(rhs, Var) and rhs.name in symbols and isinstance(lhs, str):
+                    lhs = intern_symbol(lhs)
+                return Eq(lhs, rhs)
+            return rel
+        return None if head is None else atom(head), [formula(rel) for rel in body]
+
+    def add_rule(self, head, body):
+        head, body = self.symbol_patterns(self.term_patterns(head), [self.term_patterns(rel) for rel in body])
+        self.rules.append((head, body))
+
+    def execute_rule(self, strata, head, body, variant, stmt, params):
+        '''
+        Executes a compiled statement of a rule of strata. variant is the index
+        of the atom read from delta_, None for a naive pass.
+        Returns the number of rows inserted into new_.
+        '''
+        # terms interned while compiling or by a previous statement
+        self.sync_terms()
+        if self.profiler is None:
+            return self.execute(stmt, params).rowcount
+        start = time.perf_counter()
+        rows = self.execute(stmt, params).rowcount
+        self.profiler.rule(strata, head, body, variant, stmt,
+                           params, time.perf_counter() - start, rows)
+        return rows
+
+    def slowest_rules(self, k=5):
+        '''
+        EXPLAIN QUERY PLAN of the k statements with the most time in the profiler.
+        Returns (profile entry, plan details) pairs.
+        '''
+        assert self.profiler is not None, "slowest_rules needs Solver(profile=True)"
+        res = []
+        for entry in self.profiler.to_json()["rules"][:k]:
+            stmt, params = self.profiler.statements[entry["stratum"],
+                                                    entry["rule"], entry["variant"]]
+            plan = [detail for *_, detail in self.execute(
+                f"EXPLAIN QUERY PLAN {stmt}", params).fetchall()]
+            res.append((entry, plan))
+        return res
+
+    def add_fact(self, fact: Atom):
+        # Ground facts skip rule compilation and are bulk loaded at run()
+        if all([not isinstance(arg, (Var, SQL, dict, list)) for arg in fact.args]):
+            assert len(fact.args) == len(self.rels[fact.name])
+            self.facts[fact.name].append(tuple(fact.args))
+        else:
+            self.add_rule(fact, [])
+
+    def load(self, name: str, rows, batch_size=10000):
+        '''
+        Bulk loads an iterable of tuples into relation name.
+        Rows are streamed in batches with executemany inside one transaction.
+        They are staged in the new_ table, which carries no secondary indexes,
+        and enter the base table at the next run().
+        '''
+        args = ", ".join("?" * len(self.rels[name]))
+        stmt = f"INSERT OR IGNORE INTO {new(name)} VALUES ({args})"
+        rows = iter(rows)
+        if (self.interning and SYMBOL in self.rels[name]) or TERM in self.rels[name] or len(self.con.adapters) > 0:
+            rows = (self.encode(name, row) for row in rows)
+        self.staged.add(name)
+        with self.con:
+            while True:
+                batch = list(islice(rows, batch_size))
+                if len(batch) == 0:
+                    break
+                self.cur.executemany(stmt, batch)
+                if name in self.edb_tracked:
+                    self.cur.executemany(
+                        f"INSERT OR IGNORE INTO {edb(name)} VALUES ({args})", batch)
+
+    def load_csv(self, name: str, filename, batch_size=10000, **fmtparams):
+        '''Bulk loads a csv file. Column affinity converts numeric fields.'''
+        with open(filename, newline="") as f:
+            self.load(name, csv.reader(f, **fmtparams), batch_size=batch_size)
+
+    def load_numpy(self, name: str, array, batch_size=10000):
+        '''Bulk loads the rows of a 2d array.'''
+        self.load(name, (row for n in range(0, len(array), batch_size)
+                         for row in array[n:n+batch_size].tolist()), batch_size=batch_size)
 
-    def Relation(self, name: str, *types):
+    def query_sql(self, body):
+        '''
+        SELECT statement of the distinct bindings of the variables of body,
+        in order of first appearance. Returns (statement, parameters, variables).
+        '''
+        if isinstance(body, Atom):
+            body = [body]
+        _, body = self.symbol_patterns(None, [self.term_patterns(rel) for rel in body])
+        varmap, constants, froms, wheres = compile_query(body)
+        variables = []
+        for rel in body:
+            if isinstance(rel, Atom):
+                variables += [v for arg in rel.args for v in pattern_vars(arg)
+                         if v.name not in [u.name for u in variables]]
+            elif isinstance(rel, Eq):
+                variables += [v for v in [rel.lhs, rel.rhs] if isinstance(v, Var)
+                              and v.name not in [u.name for u in variables]]
+        selects = [construct(v, varmap, constants) for v in variables]
+        # subterms of TERM columns are decoded like the columns
+        selects = [f"{keyword}_term_json({x})" if x.startswith(f"(SELECT child FROM {term_args()}") else x
+                   for x in selects]
+        selects = ", ".join(selects) if len(selects) > 0 else "1"
+        froms = " FROM " + ", ".join([f"{table} AS {row}" for table, row in froms]) if len(froms) > 0 else ""
+        wheres = " WHERE " + " AND ".join(wheres) if len(wheres) > 0 else ""
+        return f"SELECT DISTINCT {selects}{froms}{wheres}", constants, variables
+
+    def query(self, body, batch_size=10000):
+        '''
+        Lazily yields the tuples of variable bindings of an atom or a list of formulas,
+        see query_sql. Rows are fetched batch_size at a time on a separate cursor.
+        '''
+        stmt, params, variables = self.query_sql(body)
+        cur = self.con.cursor()
+        cur.execute(stmt, self.encode_params(params))
+        while True:
+            rows = cur.fetchmany(batch_size)
+            if len(rows) == 0:
+                break
+            if len(variables) == 0:
+                rows = [()] * len(rows)
+            yield from rows
+
+    def export_csv(self, body, filename, batch_size=10000, **fmtparams):
+        '''Streams the results of query(body) into a csv file. Returns the number of rows.'''
+        n = 0
+        with open(filename, "w", newline="") as f:
+            writer = csv.writer(f, **fmtparams)
+            rows = self.query(body, batch_size=batch_size)
+            while True:
+                batch = list(islice(rows, batch_size))
+                if len(batch) == 0:
+                    return n
+                writer.writerows(batch)
+                n += len(batch)
+
+    def to_columns(self, body, batch_size=10000):
+        '''
+        Results of query(body) as a dict from variable name to column buffer.
+        Integer and float columns are array.array buffers, others are lists.
+        '''
+        _, _, variables = self.query_sql(body)
+        columns = None
+        rows = self.query(body, batch_size=batch_size)
+        while True:
+            batch = list(islice(rows, batch_size))
+            if len(batch) == 0:
+                break
+            cols = list(zip(*batch))
+            if columns is None:
+                columns = [array.array("q") if isinstance(col[0], int) else
+                           array.array("d") if isinstance(col[0], float) else [] for col in cols]
+            for buf, col in zip(columns, cols):
+                buf.extend(col)
+        if columns is None:
+            columns = [array.array("q") for v in variables]
+        return {v.name: buf for v, buf in zip(variables, columns)}
+
+    def to_numpy(self, body, dtype="int64", batch_size=10000):
+        '''Results of query(body) as a 2d numpy array with one column per variable.'''
+        import numpy as np
+        _, _, variables = self.query_sql(body)
+        flat = np.fromiter((x for row in self.query(body, batch_size=batch_size) for x in row),
+                           dtype=dtype)
+        return flat.reshape(-1, len(variables))
+
+    def Relation(self, name: str, *types, provenance=None, lattice=None):
+        '''
+        Declares a relation. provenance=True keeps the timestamped old_ table
+        needed by Solver.provenance. It defaults to the provenance flag of the Solver.
+        lattice makes the last column a lattice value: the other columns are the key
+        and values derived for the same key are combined with the two argument SQL
+        function lattice, e.g. "min", "max" or a function registered on self.con.
+        '''
         assert validate(name) and keyword not in name
         assert all([validate(typ)
                    for typ in types if not isinstance(typ, Sort)])
         types = [conv_type(typ) for typ in types]
+        if self.interning:
+            types = [SYMBOL if typ == TEXT else typ for typ in types]
+        self.create_relation(name, types, provenance, lattice)
+        return lambda *args: Atom(name, args)
+
+    def create_relation(self, name, types, provenance=None, lattice=None):
+        '''Creates the tables of a relation, also for the internal relations named with keyword'''
+        if TERM in types and self.synced_terms is None:
+            self.enable_terms()
         if name not in self.rels:
             self.rels[name] = types
             args = ", ".join(
                 [f"x{n} {typ} NOT NULL" for n, typ in enumerate(types)])
             bareargs = ", ".join(
                 [f"x{n}" for n, _typ in enumerate(types)])
-            self.execute(
-                f"CREATE TABLE {name}({args}, PRIMARY KEY ({bareargs})) WITHOUT ROWID")
+            if lattice is not None:
+                assert validate(lattice) and len(types) >= 2
+                assert not self.incremental and self.workers == 1 and not (self.tracing if provenance is None else provenance), \
+                    "lattice relations do not support incremental, parallel or provenance runs"
+                self.lattices[name] = lattice
+                keys = ", ".join([f"x{n}" for n in range(len(types) - 1)])
+                self.execute(
+                    f"CREATE TABLE {name}({args}, PRIMARY KEY ({keys})) WITHOUT ROWID")
+                self.execute(
+                    f"CREATE TABLE {delta(name)}({args}, PRIMARY KEY ({keys})) WITHOUT ROWID")
+            else:
+                self.execute(
+                    f"CREATE TABLE {name}({args}, PRIMARY KEY ({bareargs})) WITHOUT ROWID")
+                self.execute(
+                    f"CREATE TABLE {delta(name)}({args}, PRIMARY KEY ({bareargs})) WITHOUT ROWID")
 
             self.execute(
                 f"CREATE TABLE {new(name)}({args}, PRIMARY KEY ({bareargs})) WITHOUT ROWID")
-            self.execute(
-                f"CREATE TABLE {delta(name)}({args}, PRIMARY KEY ({bareargs})) WITHOUT ROWID")
-            args = ", ".join(
-                [f"x{n} {typ} NOT NULL" for n, typ in enumerate(types)] + [f"{keyword}_timestamp INTEGER NOT NULL"])
-            self.execute(
-                f"CREATE TABLE {old(name)}({args}, PRIMARY KEY ({bareargs})) WITHOUT ROWID")
+            if self.tracing if provenance is None else provenance:
+                self.traced.add(name)
+                targs = ", ".join(
+                    [f"x{n} {typ} NOT NULL" for n, typ in enumerate(types)] + [f"{keyword}_timestamp INTEGER NOT NULL"])
+                self.execute(
+                    f"CREATE TABLE {old(name)}({targs}, PRIMARY KEY ({bareargs})) WITHOUT ROWID")
+            if self.incremental:
+                self.execute(
+                    f"CREATE TABLE {added(name)}({args}, PRIMARY KEY ({bareargs})) WITHOUT ROWID")
+                self.execute(
+                    f"CREATE TABLE {edb(name)}({args}, PRIMARY KEY ({bareargs})) WITHOUT ROWID")
         else:
-            assert self.rels[name] == types
-        return lambda *args: Atom(name, args)
+            assert self.rels[name] == types and self.lattices.get(name) == lattice
+
+    def drop_relation(self, name):
+        '''Drops the tables of a relation and forgets it'''
+        for table in [name, new(name), delta(name), old(name), added(name), edb(name)]:
+            self.execute(f"DROP TABLE IF EXISTS {table}")
+        del self.rels[name]
+        for d in [self.lattices, self.sizes, self.indexes, self.expression_indexes, self.selectivity]:
+            d.pop(name, None)
+        self.traced.discard(name)
+        self.staged.discard(name)
+        self.edb_tracked.discard(name)
+        self.counted.discard(name)
+
+    def build_indexes(self, plans):
+        '''
+        Creates secondary indexes on the base and delta_ tables for the binding
+        patterns and JSON paths of the rule plans. new_ tables are only inserted
+        into and scanned, so they keep just their primary key.
+        '''
+        patterns = defaultdict(set)
+        for rule in plans:
+            for name, cols in rule.bindings:
+                patterns[name].add(cols)
+            for name, expr in rule.expressions:
+                if expr in self.expression_indexes[name]:
+                    continue
+                self.expression_indexes[name].append(expr)
+                n = len(self.expression_indexes[name]) - 1
+                for table in [name, delta(name)]:
+                    self.execute(
+                        f"CREATE INDEX IF NOT EXISTS {keyword}_expr_{table}_{n} ON {table}({expr})")
+        for name, cols in patterns.items():
+            for index in choose_indexes(cols, len(self.rels[name])):
+                if index in self.indexes[name]:
+                    continue
+                self.indexes[name].append(index)
+                args = ", ".join([f"x{n}" for n in index])
+                for table in [name, delta(name)]:
+                    self.execute(
+                        f"CREATE INDEX IF NOT EXISTS {index_name(table, index)} ON {table}({args})")
+
+    def analyze(self):
+        '''
+        Refreshes the index statistics used by the join planner. Every base table
+        is counted once, after which run() keeps self.sizes up to date. ANALYZE
+        only reruns when an index was added or a relation size more than doubled
+        or halved since the previous one.
+        '''
+        for name in self.rels:
+            if name not in self.counted:
+                self.sizes[name] = self.execute(
+                    f"SELECT COUNT(*) FROM {name}").fetchone()[0]
+                self.counted.add(name)
+        indexes = {index_name(name, index): (name, index)
+                   for name, indexes in self.indexes.items() for index in indexes}
+        indexes.update({name: (name, tuple(range(len(types))))
+                       for name, types in self.rels.items()})
+        sizes = {name: self.sizes[name] for name in self.rels}
+        if self.analyzed is not None:
+            old_sizes, old_indexes = self.analyzed
+            if old_indexes == set(indexes) and all(
+                    [max(n, old) <= 2 * min(n, old) + 100 for n, old in
+                     [(n, old_sizes.get(name, 0)) for name, n in sizes.items()]]):
+                return
+        self.analyzed = (sizes, set(indexes))
+        self.execute("PRAGMA analysis_limit=1000")
+        self.execute("ANALYZE")
+        self.selectivity.clear()
+        for idx, stat in self.execute("SELECT idx, stat FROM sqlite_stat1").fetchall():
+            if idx in indexes:
+                name, index = indexes[idx]
+                rows, *avgs = map(int, stat.split()[:len(index) + 1])
+                self.selectivity[name].append((index, avgs, rows))
+
+    def estimate(self, name, rows, bound):
+        '''Estimated matches of a lookup on bound columns into rows tuples of relation name'''
+        arity = len(self.rels[name])
+        if len(bound) == 0:
+            return rows
+        if len(bound) == arity:
+            return min(rows, 1)
+        best = rows ** (1 - len(bound) / arity)
+        for index, avgs, statrows in self.selectivity[name]:
+            k = 0
+            while k < len(index) and index[k] in bound:
+                k += 1
+            if k > 0 and statrows > 0:
+                best = min(best, avgs[k - 1] * rows / statrows)
+        return best
+
+    def variant(self, head, body, rule, n, delta_size):
+        '''Semi-naive statement of the rule with body atom n read from its delta_ table'''
+        if not self.join_planner:
+            return rule.variants[n][1:]
+        atoms = [rel for rel in body if isinstance(rel, Atom)]
+
+        def estimate(m, bound):
+            name = atoms[m].name
+            rows = delta_size.get(name, 0) if m == n else self.sizes[name]
+            return self.estimate(name, rows, bound)
+        order = join_order(body, n, estimate)
+        return self.plan_cache.get_ordered(head, body, order, stats=self.stats)
+
+    def naive(self, head, body, rule):
+        if not self.join_planner:
+            return rule.naive
+        atoms = [rel for rel in body if isinstance(rel, Atom)]
+        order = join_order(body, None, lambda m, bound: self.estimate(
+            atoms[m].name, self.sizes[atoms[m].name], bound))
+        return self.plan_cache.get_ordered(head, body, order, naive=True, stats=self.stats)
+
+    def index_report(self):
+        '''
+        Returns (statement, {row alias: index}) for every compiled rule statement,
+        as chosen by EXPLAIN QUERY PLAN. The index is None for a full scan.
+        '''
+        report = []
+        for head, body in self.rules:
+            rule = self.plan_cache.get(head, body)
+            for stmt, params in [rule.naive] + [(stmt, params) for _, stmt, params in rule.variants]:
+                used = {}
+                for *_, detail in self.execute(f"EXPLAIN QUERY PLAN {stmt}", params).fetchall():
+                    m = re.match(
+                        r"(SCAN|SEARCH) (\w+)(?: USING (?:COVERING )?INDEX (\w+)| USING (PRIMARY KEY))?", detail)
+                    if m != None:
+                        used[m[2]] = m[3] or m[4]
+                report.append((stmt, used))
+        return report
+
+    def provenance_query(self, head, body, minimal):
+        '''
+        Batched provenance query of a rule. For every request in the request
+        table of the head relation it selects one derivation from the old_ tables
+        with all premises older than the request: the body atom arguments, their
+        timestamps and the proof height bound max(timestamps).
+        minimal=True picks the derivation of least height.
+        '''
+        head, body, consts = parametrize(head, body)
+        key = (rule_key(head, body), minimal)
+        if key in self.provenance_queries:
+            stmt, constants, atoms = self.provenance_queries[key]
+            return stmt, bind(constants, consts), atoms
+        req = request(head.name)
+        varmap, constants, froms, wheres = compile_query(body)
+        for table, _ in froms:
+            assert table in self.traced, f"{table} is not declared with provenance"
+        wheres += [f"{construct(arg, varmap, constants)} = {req}.x{n}" for n,
+                   arg in enumerate(head.args)]
+        wheres += [f"{row}.{keyword}_timestamp < {req}.ts" for _, row in froms]
+        atoms = [rel for rel in body if isinstance(rel, Atom)]
+        selects = [construct(arg, varmap, constants)
+                   for rel in atoms for arg in rel.args]
+        timestamps = [f"{row}.{keyword}_timestamp" for _, row in froms]
+        if len(timestamps) == 0:
+            height = "0"
+        elif len(timestamps) == 1:
+            height = timestamps[0]
+        else:
+            height = f"max({', '.join(timestamps)})"
+        order = f" ORDER BY {height}" if minimal else ""
+        selects = ", ".join([f"{req}.id"] + selects + timestamps +
+                            [height, f"ROW_NUMBER() OVER (PARTITION BY {req}.id{order}) AS {keyword}_rank"])
+        froms = ", ".join([req] + [f"{old(table)} AS {row}" for table, row in froms])
+        stmt = f"SELECT * FROM (SELECT {selects} FROM {froms} WHERE {' AND '.join(wheres)}) WHERE {keyword}_rank = 1"
+        self.provenance_queries[key] = stmt, constants, atoms
+        return stmt, bind(constants, consts), atoms
 
-    def provenance(self, fact: Atom, timestamp: int):
+    def derive(self, name, requests, minimal):
+        '''
+        Finds one derivation for each (args, timestamp) request of relation name.
+        Returns {request index: (reason, [(premise, timestamp)], height)}.
+        '''
+        types = self.rels[name]
+        req = request(name)
+        args = ", ".join([f"x{n} {typ}" for n, typ in enumerate(types)])
+        self.execute(
+            f"CREATE TEMP TABLE IF NOT EXISTS {req}(id INTEGER PRIMARY KEY, ts INTEGER, {args})")
+        self.execute(f"DELETE FROM {req}")
+        self.cur.executemany(f"INSERT INTO {req} VALUES ({', '.join('?' * (len(types) + 2))})",
+                             [(id_, ts, *self.encode(name, args)) for id_, (args, ts) in enumerate(requests)])
+        found = {}
         for rulen, (head, body) in enumerate(self.rules):
-            if head.name != fact.name or len(head.args) != len(fact.args):
+            if head.name != name or len(head.args) != len(types):
                 continue
-            query = [Eq(a, b) for a, b in zip(
-                head.args, fact.args)] + body
-            print(query)
-            varmap, constants, froms, wheres = compile_query(query)
-            wheres += [f"{row}.{keyword}_timestamp < :timestamp" for _, row in froms]
-            # This section is repetitive
-            if len(wheres) > 0:
-                wheres = " WHERE " + " AND ".join(wheres)
-            else:
-                wheres = ""
-            constants["timestamp"] = timestamp
-
-            body_atoms = [
-                rel for rel in body if isinstance(rel, Atom)]
-            selects = [arg for rel in body_atoms for arg in rel.args]
-            assert len(body_atoms) == len(froms)
-            assert all([r1.name == table for r1, (table, _)
-                        in zip(body_atoms, froms)])
-            selects = [construct(arg, varmap, constants) for arg in selects]
-            timestampind = len(selects)
-            selects += [f"{row}.{keyword}_timestamp" for _, row in froms]
-            selects = ", ".join(selects)
-            if selects == "":
-                selects = " * "
-            if len(froms) > 0:
-                froms = " FROM " + \
-                    ", ".join(
-                        [f"{old(table)} AS {row}" for table, row in froms])
-            else:
-                froms = " FROM (VALUES (42)) "
-            # order by sum(timestamps) limit 1
-            self.execute(f"SELECT {selects} {froms} {wheres}", constants)
-            res = self.cur.fetchone()
-            if res != None:
-                timestamps = res[timestampind:]
-                subproofs = []
-                for rel, timestamp in zip(body, timestamps):
+            stmt, params, atoms = self.provenance_query(head, body, minimal)
+            for id_, *res in self.execute(stmt, params).fetchall():
+                height = res[-2]
+                if id_ in found and (not minimal or found[id_][2] <= height):
+                    continue
+                timestamps = res[-2 - len(atoms):-2]
+                premises = []
+                for rel, timestamp in zip(atoms, timestamps):
                     nargs = len(rel.args)
-                    q = Atom(rel.name, res[:nargs])
+                    premises.append((Atom(rel.name, tuple(self.decode(rel.name, res[:nargs]))), timestamp))
                     res = res[nargs:]
-                    subproofs.append(self.provenance(q, timestamp))
-                return Proof(fact, subproofs, rulen)
-        raise BaseException(
-            f"No rules applied to derivation of {fact}, {timestamp}")
+                found[id_] = (rulen, premises, height)
+        if len(found) < len(requests):
+            # Loaded facts have no rule
+            self.execute(
+                f"SELECT id FROM {req} WHERE EXISTS (SELECT * FROM {old(name)} WHERE {match_columns(req, old(name), len(types))} AND {keyword}_timestamp <= {req}.ts)")
+            for id_, in self.cur.fetchall():
+                if id_ not in found:
+                    found[id_] = ("fact", [], 0)
+        return found
 
-    def stratify(self):
+    def decode(self, name, row):
+        '''Python values of the TERM columns of a selected row, as ids or JSON text'''
+        return [x if typ != TERM else term_value(x) if isinstance(x, int) else json.loads(x)
+                for x, typ in zip(row, self.rels[name])]
+
+    def explain(self, facts: List[Atom], timestamps=None, minimal=False):
+        '''
+        Proofs of many facts at once.
+        The premises of a derivation are older than the given timestamp, which
+        defaults to the timestamp at which the fact was derived.
+        Subproofs are memoized per (fact, timestamp), so the proofs form a DAG
+        sharing common subproofs, and every level of the proofs is found with
+        one query per rule. minimal=True picks proofs of least height.
+        '''
+        if timestamps is None:
+            timestamps = []
+            for fact in facts:
+                assert fact.name in self.traced, f"{fact.name} is not declared with provenance"
+                wheres = " AND ".join(
+                    [f"x{n} = ?" for n in range(len(fact.args))])
+                res = self.execute(
+                    f"SELECT {keyword}_timestamp FROM {old(fact.name)} WHERE {wheres}", self.encode(fact.name, fact.args)).fetchone()
+                if res is None:
+                    raise BaseException(f"{fact} was not derived")
+                timestamps.append(res[0])
+        memo = self.proofs[minimal]
+
+        def key(fact, timestamp):
+            return fact.name, repr(tuple(fact.args)), timestamp
+        derivations = {}
+        frontier = {key(fact, ts): (fact, ts)
+                    for fact, ts in zip(facts, timestamps)}
+        while len(frontier) > 0:
+            byrel = defaultdict(list)
+            for k, (fact, ts) in frontier.items():
+                if k not in memo and k not in derivations:
+                    assert fact.name in self.traced, f"{fact.name} is not declared with provenance"
+                    byrel[fact.name].append((k, fact, ts))
+            frontier = {}
+            for name, requests in byrel.items():
+                found = self.derive(
+                    name, [(tuple(fact.args), ts) for _, fact, ts in requests], minimal)
+                for id_, (k, fact, ts) in enumerate(requests):
+                    if id_ not in found:
+                        raise BaseException(
+                            f"No rules applied to derivation of {fact}, {ts}")
+                    reason, premises, _ = found[id_]
+                    derivations[k] = (fact, ts, reason, [key(*p) for p in premises])
+                    frontier.update({key(*p): p for p in premises})
+        # premises are strictly older than their conclusion
+        for k, (fact, ts, reason, premises) in sorted(derivations.items(), key=lambda d: d[1][1]):
+            memo[k] = Proof(fact, [memo[p] for p in premises], reason)
+        return [memo[key(fact, ts)] for fact, ts in zip(facts, timestamps)]
+
+    def provenance(self, fact: Atom, timestamp: int = None, minimal=False):
+        if timestamp is None:
+            return self.explain([fact], minimal=minimal)[0]
+        return self.explain([fact], [timestamp], minimal=minimal)[0]
+
+    def dependency_graph(self):
         G = nx.DiGraph()
+        # relations without rules may still have loaded facts
+        G.add_nodes_from(self.rels if self.slice is None else self.slice)
 
         for head, body in self.rules:
             # if len(body) == 0:
@@ -357,63 +1592,577 @@ class Solver(BaseSolver):
                 elif isinstance(rel, Not):
                     assert isinstance(rel.val, Atom)
                     G.add_edge(rel.val.name, head.name)
+        return G
 
+    def stratify(self):
+        G = self.dependency_graph()
         scc = list(nx.strongly_connected_components(G))
         cond = nx.condensation(G, scc=scc)
         for n in nx.topological_sort(cond):
             # TODO: negation check
             yield scc[n]
 
-    def run(self):
-        timestamp = 0
-        for strata in self.stratify():
-            timestamp += 1
-            stmts = []
+    def adornment(self, atom, bound):
+        '''"b" for the arguments of atom fixed by constants and the variable names in bound, "f" otherwise'''
+        return "".join(["f" if isinstance(arg, SQL) or any([v.name not in bound for v in pattern_vars(arg)])
+                         else "b" for arg in atom.args])
+
+    def magic_rules(self, goal: Atom):
+        '''
+        Magic sets rewrite of the rules for goal, with sideways information passed
+        left to right. Relation p queried with bound arguments adornment a gets an
+        adorned copy litelog_demand_p_a, whose rules are guarded by the demanded
+        bindings in litelog_magic_p_a. Relations only queried with free arguments or
+        under negation keep their own rules. The adorned and magic relations are
+        created here, see demand. Returns (rules, their names, goal adornment).
+        '''
+        idb = {head.name for head, body in self.rules}
+        goal_adornment = self.adornment(goal, set())
+        todo = [(goal.name, goal_adornment)]
+        done = set()
+        rules = []
+        # relations evaluated in full by their own rules
+        full = set()
+        while len(todo) > 0:
+            name, a = todo.pop()
+            if (name, a) in done:
+                continue
+            done.add((name, a))
+            types = self.rels[name]
+            self.create_relation(adorned_name(name, a), types,
+                                 provenance=False, lattice=self.lattices.get(name))
+            self.create_relation(magic_name(name, a), [typ for typ, x in zip(types, a) if x == "b"],
+                                 provenance=False)
             for head, body in self.rules:
+                if head.name != name:
+                    continue
+                margs = tuple([Var(f"{keyword}_magic{n}") if isinstance(arg, SQL) else arg
+                               for n, (arg, x) in enumerate(zip(head.args, a)) if x == "b"])
+                magic = Atom(magic_name(name, a), margs)
+                bound = {v.name for arg in margs for v in pattern_vars(arg)}
+                prefix = [magic]
+                adorned = [magic]
+                for rel in body:
+                    if isinstance(rel, Atom) and rel.name in idb:
+                        b = self.adornment(rel, bound)
+                        if "b" in b:
+                            rules.append((Atom(magic_name(rel.name, b), tuple([arg for arg, x in zip(rel.args, b) if x == "b"])),
+                                          list(prefix)))
+                            todo.append((rel.name, b))
+                            rel = Atom(adorned_name(rel.name, b), rel.args)
+                        else:
+                            full.add(rel.name)
+                    elif isinstance(rel, Not) and rel.val.name in idb:
+                        full.add(rel.val.name)
+                    adorned.append(rel)
+                    # filters and negations are left out of the magic rules, which only widens the demand
+                    if isinstance(rel, Atom):
+                        prefix.append(rel)
+                        bound.update([v.name for arg in rel.args for v in pattern_vars(arg)])
+                    elif isinstance(rel, Eq):
+                        prefix.append(rel)
+                        bound.update([v.name for v in pattern_vars(rel.lhs) + pattern_vars(rel.rhs)])
+                rules.append((Atom(adorned_name(name, a), head.args), adorned))
+            # tuples of name already in its table
+            xs = [Var(f"{keyword}_x{n}") for n in range(len(types))]
+            rules.append((Atom(adorned_name(name, a), tuple(xs)),
+                          [Atom(magic_name(name, a), tuple([v for v, x in zip(xs, a) if x == "b"])), Atom(name, tuple(xs))]))
+        G = self.dependency_graph()
+        for name in list(full):
+            full.update(nx.ancestors(G, name))
+        rules += [(head, body) for head, body in self.rules if head.name in full]
+        return rules, [f(name, a) for name, a in done for f in [adorned_name, magic_name]], goal_adornment
+
+    def demand(self, goal: Atom, batch_size=10000):
+        '''
+        Answers goal, an atom with constant arguments, by evaluating only the tuples
+        it depends on, see magic_rules. Returns the list of bindings of the variables
+        of goal like query. The adorned and magic relations are dropped afterwards.
+        '''
+        assert not self.incremental, "demand is not supported with incremental=True"
+        goal = self.term_patterns(goal)
+        if goal.name not in {head.name for head, body in self.rules} or "b" not in self.adornment(goal, set()):
+            self.run()
+            return list(self.query(goal, batch_size=batch_size))
+        saved = self.rules
+        names = []
+        try:
+            rules, names, a = self.magic_rules(goal)
+            self.load(magic_name(goal.name, a), [[arg for arg, x in zip(goal.args, a) if x == "b"]])
+            self.rules = rules
+            self.run()
+            return list(self.query(Atom(adorned_name(goal.name, a), goal.args), batch_size=batch_size))
+        finally:
+            self.rules = saved
+            for name in names:
+                self.drop_relation(name)
+
+    def check_incremental(self):
+        '''
+        An incremental run only adds tuples. It cannot retract conclusions of an
+        already evaluated rule whose negated relation may grow.
+        '''
+        G = self.dependency_graph()
+        changed = {name for name in self.staged if name in G}
+        changed.update([head.name for head, body in self.rules
+                        if rule_key(head, body) not in self.evaluated])
+        for name in list(changed):
+            changed.update(nx.descendants(G, name))
+        for head, body in self.rules:
+            if rule_key(head, body) in self.evaluated:
+                for rel in body:
+                    if isinstance(rel, Not) and rel.val.name in changed:
+                        raise Exception(
+                            f"Incremental run can not maintain {head} :- {body}. {rel.val.name} may grow under negation.")
+
+    def retract(self, *facts: Atom):
+        '''
+        Removes ground facts and the conclusions that depended on them, by
+        delete and rederive (DRed):
+        every tuple with a derivation using a removed tuple is overdeleted,
+        stratum by stratum against the old database, then the overdeleted tuples
+        that still have a derivation are rederived and propagated semi-naively.
+        Requires incremental=True. Pending facts and rules are run first so the
+        database starts at a fixpoint.
+        '''
+        assert self.incremental
+        if len(self.facts) > 0 or len(self.staged) > 0 or \
+                any([rule_key(head, body) not in self.evaluated for head, body in self.rules]):
+            self.run()
+        retracted = defaultdict(list)
+        for fact in facts:
+            assert all([not isinstance(arg, (Var, SQL, dict, list))
+                       for arg in fact.args])
+            retracted[fact.name].append(self.encode(fact.name, fact.args))
+        G = self.dependency_graph()
+        shrinking = set(retracted)
+        for name in retracted:
+            shrinking.update(nx.descendants(G, name))
+        for head, body in self.rules:
+            for rel in body:
+                if isinstance(rel, Not) and rel.val.name in shrinking:
+                    raise Exception(
+                        f"Retraction can not maintain {head} :- {body}. {rel.val.name} may shrink under negation.")
+        for proofs in self.proofs.values():
+            proofs.clear()
+        plans = [self.plan_cache.get(head, body, self.stats)
+                 for head, body in self.rules]
+        stratification = list(self.stratify())
+        # Overdelete. added_ collects the overdeleted tuples of every relation,
+        # which are exposed to higher strata in delta_
+        delta_size = defaultdict(int)
+        for strata in stratification:
+            for name in strata:
+                if name in retracted:
+                    wheres = " AND ".join(
+                        [f"x{n} = ?" for n in range(len(self.rels[name]))])
+                    args = ", ".join("?" * len(self.rels[name]))
+                    if name in self.edb_tracked:
+                        self.cur.executemany(
+                            f"DELETE FROM {edb(name)} WHERE {wheres}", retracted[name])
+                    self.cur.executemany(
+                        f"INSERT OR IGNORE INTO {new(name)} VALUES ({args})", retracted[name])
+            stmts = []
+            for (head, body), rule in zip(self.rules, plans):
                 if head.name in strata:
-                    # if len(body) == 0:
-                    #    self.add_fact(head)
-                    if any([rel.name in strata for rel in body if isinstance(rel, Atom)]):
-                        stmts += compile(head, body)
-                    else:
-                        # These are not recursive rules
-                        # They need to be run once naively and can then be forgotten
-                        stmt, params = compile(head, body, naive=True)
-                        self.execute(stmt, params)
-            # Prepare initial delta relation
+                    for n, (name, _, _) in enumerate(rule.variants):
+                        if name in strata:
+                            stmts.append((head, body, rule, n))
+                        elif delta_size[name] > 0:
+                            stmt, params = self.variant(
+                                head, body, rule, n, delta_size)
+                            self.execute_rule(strata, head, body, n, stmt, params)
+            while True:
+                for name in strata:
+                    if delta_size[name] > 0:
+                        self.execute(f"DELETE FROM {delta(name)}")
+                    delta_size[name] = self.update_deleted(name)
+                if not any([delta_size[name] for name in strata]):
+                    break
+                for head, body, rule, n in stmts:
+                    stmt, params = self.variant(head, body, rule, n, delta_size)
+                    self.execute_rule(strata, head, body, n, stmt, params)
             for name in strata:
+                delta_size[name] = self.execute(
+                    f"INSERT INTO {delta(name)} SELECT * FROM {added(name)}").rowcount
+        overdeleted = dict(delta_size)
+        for name, n in overdeleted.items():
+            if n > 0:
+                self.execute(f"DELETE FROM {delta(name)}")
+                delta_size[name] = 0
+                arity = len(self.rels[name])
+                for table in [name, old(name)] if name in self.traced else [name]:
+                    self.execute(
+                        f"DELETE FROM {table} WHERE EXISTS (SELECT * FROM {added(name)} WHERE {match_columns(added(name), table, arity)})")
+                self.sizes[name] -= n
+        # Rederive
+        for strata in stratification:
+            self.timestamp += 1
+            stmts = []
+            for (head, body), rule in zip(self.rules, plans):
+                if head.name in strata:
+                    if overdeleted.get(head.name, 0) > 0:
+                        stmt, params = self.rederive(head, body)
+                        self.execute_rule(strata, head, body, None, stmt, params)
+                    stmts += [(head, body, rule, n) for n, (name, _, _) in enumerate(rule.variants)
+                              if name in strata]
+            for name in strata:
+                if overdeleted.get(name, 0) > 0:
+                    if name in self.edb_tracked:
+                        self.execute(
+                            f"INSERT OR IGNORE INTO {new(name)} SELECT * FROM {added(name)} WHERE EXISTS (SELECT * FROM {edb(name)} WHERE {match_columns(added(name), edb(name), len(self.rels[name]))})")
+                    self.execute(f"DELETE FROM {added(name)}")
+                delta_size[name] = self.update_delta(name, self.timestamp)
+            self.seminaive(strata, stmts, delta_size)
+
+    def rederive(self, head, body):
+        '''
+        Naive statement of the rule restricted to the overdeleted tuples of its head,
+        by joining the added_ table of the head first.
+        '''
+        args = []
+        constraints = []
+        for n, arg in enumerate(head.args):
+            if isinstance(arg, SQL):
+                x = Var(f"{keyword}_head{n}")
+                args.append(x)
+                constraints.append(f"{{{x.name}}} = ({arg.expr})")
+            else:
+                args.append(arg)
+        body = [Atom(added(head.name), args)] + body + constraints
+        return self.plan_cache.get(head, body, self.stats).naive
+
+    def update_deleted(self, name):
+        '''
+        Moves the tuples of new_ that are in the base table and not yet overdeleted
+        into delta_ and added_. Returns their number.
+        '''
+        arity = len(self.rels[name])
+        n = self.execute(
+            f"INSERT OR IGNORE INTO {delta(name)} SELECT * FROM {new(name)} WHERE EXISTS (SELECT * FROM {name} WHERE {match_columns(new(name), name, arity)}) AND NOT EXISTS (SELECT * FROM {added(name)} WHERE {match_columns(new(name), added(name), arity)})").rowcount
+        if n > 0:
+            self.execute(
+                f"INSERT INTO {added(name)} SELECT * FROM {delta(name)}")
+        self.execute(f"DELETE FROM {new(name)}")
+        return n
+
+    def update_delta(self, name, timestamp):
+        '''
+        Moves the tuples of new_ that are not yet in the base table into delta_
+        and the base table. Returns the number of such tuples, taken from the
+        statement row count.
+        '''
+        wheres = " AND ".join(
+            [f"{new(name)}.x{n} = {name}.x{n}" for n in range(len(self.rels[name]))])
+        n = self.execute(
+            f"INSERT OR IGNORE INTO {delta(name)} SELECT * FROM {new(name)} WHERE NOT EXISTS (SELECT * FROM {name} WHERE {wheres})").rowcount
+        if n > 0:
+            self.sizes[name] += n
+            self.execute(
+                f"INSERT OR IGNORE INTO {name} SELECT * FROM {delta(name)}")
+            if name in self.traced:
                 self.execute(
-                    f"INSERT OR IGNORE INTO {delta(name)} SELECT DISTINCT * FROM {new(name)}")
+                    f"INSERT OR IGNORE INTO {old(name)} SELECT *, ? FROM {delta(name)}", (timestamp,))
+        self.execute(f"DELETE FROM {new(name)}")
+        return n
+
+    def update_lattice(self, name, initial=False):
+        '''
+        Combines the candidate tuples of new_ per key with the lattice function and
+        upserts them into the base table with INSERT ... ON CONFLICT DO UPDATE.
+        Only keys whose value strictly improved are left in delta_, unless initial.
+        Returns the number of tuples in delta_.
+        '''
+        f = self.lattices[name]
+        arity = len(self.rels[name])
+        keys = ", ".join([f"x{n}" for n in range(arity - 1)])
+        v = f"x{arity - 1}"
+        match = match_columns(name, delta(name), arity - 1)
+        self.execute(
+            f"INSERT INTO {delta(name)} SELECT * FROM {new(name)} WHERE true ON CONFLICT ({keys}) DO UPDATE SET {v} = {f}({v}, excluded.{v})")
+        self.execute(
+            f"UPDATE {delta(name)} SET {v} = (SELECT {f}({name}.{v}, {delta(name)}.{v}) FROM {name} WHERE {match}) WHERE EXISTS (SELECT * FROM {name} WHERE {match})")
+        if not initial:
+            self.execute(
+                f"DELETE FROM {delta(name)} WHERE EXISTS (SELECT * FROM {name} WHERE {match} AND {name}.{v} = {delta(name)}.{v})")
+        self.sizes[name] += self.execute(
+            f"SELECT COUNT(*) FROM {delta(name)} WHERE NOT EXISTS (SELECT * FROM {name} WHERE {match})").fetchone()[0]
+        n = self.execute(
+            f"INSERT INTO {name} SELECT * FROM {delta(name)} WHERE true ON CONFLICT ({keys}) DO UPDATE SET {v} = excluded.{v}").rowcount
+        self.execute(f"DELETE FROM {new(name)}")
+        return n
+
+    def seminaive(self, strata, stmts, delta_size, accumulate=False):
+        '''
+        Seminaive loop. Only the relations of the current strata can change.
+        stmts are (head, body, plan, atom index) of the variants to run each iteration.
+        With accumulate=True every delta is also collected in the added_ tables.
+        '''
+        # rows inserted into new_ since the last delta update
+        pending = defaultdict(int)
+        while True:
+            if accumulate:
+                for name in strata:
+                    if delta_size[name] > 0:
+                        self.execute(
+                            f"INSERT INTO {added(name)} SELECT * FROM {delta(name)}")
+            if not any([delta_size[name] for name in strata]):
+                break
+            self.timestamp += 1
+            if self.profiler is not None:
+                self.profiler.iteration(strata)
+            for head, body, rule, n in stmts:
+                stmt, params = self.variant(head, body, rule, n, delta_size)
+                pending[head.name] += self.execute_rule(
+                    strata, head, body, n, stmt, params)
+            for name in strata:
+                if delta_size[name] > 0:
+                    self.execute(f"DELETE FROM {delta(name)}")
+                if pending[name] > 0 and name in self.lattices:
+                    delta_size[name] = self.update_lattice(name)
+                elif pending[name] > 0:
+                    delta_size[name] = self.update_delta(name, self.timestamp)
+                else:
+                    delta_size[name] = 0
+                pending[name] = 0
+
+    def run_stratum(self, strata, plans, delta_size, accumulate=None):
+        '''
+        Evaluates the rules of one stratum to a fixpoint.
+        With accumulate=True the delta_ tables of the stratum end up holding every
+        tuple added to it. This is the default in incremental mode.
+        '''
+        if accumulate is None:
+            accumulate = self.incremental
+        if self.profiler is not None:
+            start = time.perf_counter()
+            sizes = sum([self.sizes[name] for name in strata])
+            # loaded facts waiting in new_
+            loaded = sum([self.execute(f"SELECT COUNT(*) FROM {new(name)}").fetchone()[0]
+                          for name in strata])
+        self.timestamp += 1
+        stmts = []
+        for (head, body), rule in zip(self.rules, plans):
+            if head.name in strata:
+                # if len(body) == 0:
+                #    self.add_fact(head)
+                recursive = any(
+                    [rel.name in strata for rel in body if isinstance(rel, Atom)])
+                if self.incremental and rule_key(head, body) in self.evaluated:
+                    # Only derivations using a tuple added to a lower stratum are new
+                    for n, (name, _, _) in enumerate(rule.variants):
+                        if name not in strata and delta_size[name] > 0:
+                            stmt, params = self.variant(
+                                head, body, rule, n, delta_size)
+                            self.execute_rule(strata, head, body, n, stmt, params)
+                elif self.incremental or not recursive:
+                    # These need to be run once naively and can then be forgotten
+                    stmt, params = self.naive(head, body, rule)
+                    self.execute_rule(strata, head, body, None, stmt, params)
+                if recursive:
+                    stmts += [(head, body, rule, n) for n, (name, _, _) in enumerate(rule.variants)
+                              if name in strata]
+        # Prepare initial delta relation
+        for name in strata:
+            if self.incremental:
+                delta_size[name] = self.update_delta(name, self.timestamp)
+                continue
+            if name in self.lattices:
+                delta_size[name] = self.update_lattice(name, initial=True)
+                continue
+            delta_size[name] = self.execute(
+                f"INSERT OR IGNORE INTO {delta(name)} SELECT DISTINCT * FROM {new(name)}").rowcount
+            self.sizes[name] += self.execute(
+                f"INSERT OR IGNORE INTO {name} SELECT DISTINCT * FROM {new(name)}").rowcount
+            if name in self.traced:
                 self.execute(
-                    f"INSERT OR IGNORE INTO {name} SELECT DISTINCT * FROM {new(name)}")
+                    f"INSERT OR IGNORE INTO {old(name)} SELECT *, ? FROM {new(name)}", (self.timestamp,))
+            self.execute(
+                f"DELETE FROM {new(name)}")
+        self.seminaive(strata, stmts, delta_size, accumulate=accumulate)
+        if accumulate:
+            # Expose everything this run added to the higher strata
+            for name in strata:
+                delta_size[name] = self.execute(
+                    f"INSERT INTO {delta(name)} SELECT * FROM {added(name)}").rowcount
+                if delta_size[name] > 0:
+                    self.execute(f"DELETE FROM {added(name)}")
+        if self.profiler is not None:
+            self.profiler.stratum(strata, time.perf_counter() - start, loaded,
+                                  sum([self.sizes[name] for name in strata]) - sizes)
+
+    def run_worker(self, strata, plans, delta_size, filename):
+        '''
+        Evaluates a stratum on a fresh connection to the database filename. The
+        tables of the stratum are copied there and the shared database is attached
+        read only, so unqualified names of lower strata relations resolve to it.
+        Returns the worker solver.
+        '''
+        worker = copy(self)
+        worker.con = sqlite3.connect(filename, detect_types=sqlite3.PARSE_DECLTYPES, factory=Connection,
+                                     cached_statements=self.cached_statements, check_same_thread=False, uri=True)
+        worker.cur = worker.con.cursor()
+        worker.stats = defaultdict(int)
+        # merge() adds the rows the worker derived to the shared sizes
+        worker.sizes = copy(self.sizes)
+        if self.on_connect != None:
+            self.on_connect(worker.con)
+        shared = Path(self.database).absolute().as_uri() + "?mode=ro"
+        worker.execute(f"ATTACH DATABASE ? AS {keyword}_shared", (shared,))
+        tables = {table for name in strata for table in [name, new(name), delta(name), old(name), added(name)]}
+        schema = worker.execute(
+            f"SELECT type, tbl_name, sql FROM {keyword}_shared.sqlite_master WHERE sql NOT NULL ORDER BY type = 'index'").fetchall()
+        for typ, table, sql in schema:
+            if table in tables:
+                worker.execute(sql)
+        for name in strata:
+            worker.execute(
+                f"INSERT INTO main.{name} SELECT * FROM {keyword}_shared.{name}")
+            worker.execute(
+                f"INSERT INTO main.{new(name)} SELECT * FROM {keyword}_shared.{new(name)}")
+            if not self.incremental:
+                worker.execute(
+                    f"CREATE TABLE main.{added(name)} AS SELECT * FROM main.{delta(name)}")
+        worker.run_stratum(strata, plans, delta_size, accumulate=True)
+        worker.con.commit()
+        worker.con.close()
+        return worker
+
+    def merge(self, strata, worker, filename, delta_size):
+        '''Copies the tuples a worker added to strata into the shared database'''
+        w = f"{keyword}_worker"
+        self.execute(f"ATTACH DATABASE ? AS {w}", (filename,))
+        for name in strata:
+            self.sizes[name] += self.execute(
+                f"INSERT OR IGNORE INTO main.{name} SELECT * FROM {w}.{delta(name)}").rowcount
+            if name in self.traced:
                 self.execute(
-                    f"INSERT OR IGNORE INTO {old(name)} SELECT *, ? FROM {new(name)}", (timestamp,))
+                    f"INSERT OR IGNORE INTO main.{old(name)} SELECT * FROM {w}.{old(name)}")
+            self.execute(f"DELETE FROM main.{new(name)}")
+            if self.incremental:
                 self.execute(
-                    f"DELETE FROM {new(name)}")
-            # Seminaive loop
-            while True:
-                timestamp += 1
-                for stmt, params in stmts:
-                    self.execute(stmt, params)
-                num_new = 0
-                for name, types in self.rels.items():
-                    self.execute(f"DELETE FROM {delta(name)}")
-                    wheres = " AND ".join(
-                        [f"{new(name)}.x{n} = {name}.x{n}" for n in range(len(types))])
-                    self.execute(
-                        f"INSERT OR IGNORE INTO {delta(name)} SELECT DISTINCT * FROM {new(name)}")
-                    wheres = " AND ".join(
-                        [f"{delta(name)}.x{n} = {name}.x{n}" for n in range(len(types))])
-                    self.execute(
-                        f"DELETE FROM {delta(name)} WHERE EXISTS (SELECT * FROM {name} WHERE {wheres})")
-                    self.execute(
-                        f"INSERT OR IGNORE INTO {name} SELECT * FROM {delta(name)}")
-                    self.execute(
-                        f"INSERT OR IGNORE INTO {old(name)} SELECT *, ? FROM {delta(name)}", (timestamp,))
-                    self.execute(f"DELETE FROM {new(name)}")
+                    f"INSERT INTO main.{delta(name)} SELECT * FROM {w}.{delta(name)}")
+            else:
+                delta_size[name] = 0
+        self.con.commit()
+        self.execute(f"DETACH DATABASE {w}")
+        self.timestamp = max(self.timestamp, worker.timestamp)
+        for k, v in worker.stats.items():
+            self.stats[k] += v
 
-                    self.execute(f"SELECT COUNT(*) FROM {delta(name)}")
-                    n = self.cur.fetchone()[0]
-                    num_new += n
-                if num_new == 0:
-                    break
+    def run_parallel(self, plans, delta_size):
+        '''
+        Runs strata with no dependency path between them concurrently on up to
+        self.workers threads. Each worker writes to its own database file, which
+        is merged into the shared WAL mode database once the stratum is done.
+        A stratum that is the only one ready runs directly on the shared connection.
+        '''
+        G = self.dependency_graph()
+        scc = list(nx.strongly_connected_components(G))
+        cond = nx.condensation(G, scc=scc)
+        indegree = dict(cond.in_degree())
+        ready = [n for n, d in indegree.items() if d == 0]
+        running = {}
+        with tempfile.TemporaryDirectory() as tmpdirname, ThreadPoolExecutor(self.workers) as pool:
+            while len(ready) > 0 or len(running) > 0:
+                finished = []
+                if len(ready) == 1 and len(running) == 0:
+                    n = ready.pop()
+                    self.run_stratum(scc[n], plans, delta_size)
+                    finished.append(n)
+                else:
+                    self.con.commit()
+                    for n in ready:
+                        filename = str(Path(tmpdirname) / f"stratum{n}.db")
+                        fut = pool.submit(self.run_worker,
+                                          scc[n], plans, delta_size, filename)
+                        running[fut] = n, filename
+                    ready = []
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for fut in done:
+                        n, filename = running.pop(fut)
+                        self.merge(scc[n], fut.result(), filename, delta_size)
+                        finished.append(n)
+                for n in finished:
+                    for m in cond.successors(n):
+                        indegree[m] -= 1
+                        if indegree[m] == 0:
+                            ready.append(m)
+        self.con.commit()
+
+    def run(self, outputs=None):
+        '''
+        Evaluates the rules to a fixpoint, stratum by stratum.
+        With incremental=True, rules evaluated by an earlier run are only fed the
+        tuples added since then: the delta_ table of every relation of a finished
+        stratum holds all of its tuples added during this run, and rules of higher
+        strata run their semi-naive variants over those deltas instead of a naive
+        pass over the whole database.
+        outputs, a list of relation names, slices the program to the relations they
+        depend on. The other relations, their rules and strata are skipped and
+        listed in the returned report, also kept in self.slice_report.
+        '''
+        if outputs is None:
+            return self.fixpoint()
+        unknown = [name for name in outputs if name not in self.rels]
+        if len(unknown) > 0:
+            raise Exception(f"Unknown output relations {unknown}")
+        G = self.dependency_graph()
+        needed = set(outputs)
+        for name in outputs:
+            needed.update(nx.ancestors(G, name))
+        skipped = set(self.rels) - needed
+        cond = nx.condensation(G)
+        self.slice_report = {
+            "outputs": sorted(outputs),
+            "relations": sorted(skipped),
+            "rules": [f"{head} :- {body}" for head, body in self.rules if head.name in skipped],
+            "strata": len([n for n, members in cond.nodes(data="members") if members <= skipped])}
+        saved = self.rules
+        self.rules = [(head, body) for head, body in self.rules if head.name in needed]
+        self.slice = needed
+        try:
+            self.fixpoint()
+        finally:
+            self.rules = saved
+            self.slice = None
+        if self.debug:
+            print("skipped", self.slice_report)
+        return self.slice_report
+
+    def fixpoint(self):
+        for name, rows in self.facts.items():
+            self.load(name, rows)
+        self.facts.clear()
+        self.sync_symbols()
+        if self.incremental:
+            self.check_incremental()
+            for name in {head.name for head, body in self.rules} - self.edb_tracked:
+                # No rule derived name before, so all of its tuples are facts
+                self.execute(
+                    f"INSERT OR IGNORE INTO {edb(name)} SELECT * FROM {name}")
+                self.execute(
+                    f"INSERT OR IGNORE INTO {edb(name)} SELECT * FROM {new(name)}")
+                self.edb_tracked.add(name)
+        plans = [self.plan_cache.get(head, body, self.stats)
+                 for head, body in self.rules]
+        if self.auto_index:
+            self.build_indexes(plans)
+        if self.join_planner:
+            self.analyze()
+        # current delta_ size of every relation
+        delta_size = defaultdict(int)
+        if self.workers > 1:
+            self.run_parallel(plans, delta_size)
+        else:
+            for strata in self.stratify():
+                self.run_stratum(strata, plans, delta_size)
+        if self.incremental:
+            for name, n in delta_size.items():
+                if n > 0:
+                    self.execute(f"DELETE FROM {delta(name)}")
+            self.evaluated.update([rule_key(head, body)
+                                  for head, body in self.rules])
+        # loaded tuples of relations outside the slice stay staged
+        self.staged = {name for name in self.staged
+                       if self.slice is not None and name not in self.slice}
@@ -0,0 +1,432 @@
+import re
+from collections import defaultdict
+import numpy as np
+import networkx as nx
+from .common import *
+
+'''
+In memory datalog engine over numpy arrays.
+Every relation is an (n, arity) int64 array of distinct rows. Symbols are
+interned to integers and decoded only when results are read through the cursor.
+Rules are evaluated semi-naively with vectorized sort-merge joins, probing
+sorted indexes of the relations that are kept across iterations and runs.
+'''
+
+INTEGER = "INTEGER"
+TEXT = "TEXT"
+
+
+def conv_type(typ):
+    if typ == Sort.NUMBER:
+        return INTEGER
+    elif typ == Sort.SYMBOL:
+        return TEXT
+    else:
+        return typ
+
+
+def empty(arity):
+    return np.zeros((0, arity), dtype=np.int64)
+
+
+def unique_rows(rows):
+    if len(rows) == 0 or rows.shape[1] == 0:
+        return rows[:min(len(rows), 1)]
+    key, _ = row_ids(rows, rows[:0])
+    _, idx = np.unique(key, return_index=True)
+    return rows[idx]
+
+
+def row_ids(a, b):
+    '''Integer ids of the rows of a and b, equal rows getting equal ids'''
+    if a.shape[1] == 1:
+        return a[:, 0], b[:, 0]
+    rows = np.concatenate([a, b])
+    lo, hi = rows.min(axis=0), rows.max(axis=0)
+    # mixed radix over the column ranges when it fits in an int64
+    if np.prod((hi - lo + 1).astype(float)) < 2 ** 62:
+        key = np.zeros(len(rows), dtype=np.int64)
+        for col, l, h in zip(rows.T, lo, hi):
+            key = key * (h - l + 1) + (col - l)
+    else:
+        _, key = np.unique(rows, axis=0, return_inverse=True)
+        key = key.reshape(-1)
+    return key[:len(a)], key[len(a):]
+
+
+def join_indices(a, b):
+    '''
+    Sort-merge join on key arrays a (n, k) and b (m, k).
+    Returns index arrays (i, j) of all pairs with a[i] == b[j].
+    '''
+    n, m = len(a), len(b)
+    if a.shape[1] == 0:
+        return np.repeat(np.arange(n), m), np.tile(np.arange(m), n)
+    if n == 0 or m == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    ka, kb = row_ids(a, b)
+    order = np.argsort(kb, kind="stable")
+    return merge_indices(ka, kb[order], order)
+
+
+def merge_indices(ka, kb, order, mask=None):
+    '''
+    Index arrays (i, j) of all pairs with ka[i] == kb[k] and j = order[k],
+    for kb sorted. Keys of ka outside mask match nothing.
+    '''
+    starts = np.searchsorted(kb, ka, "left")
+    counts = np.searchsorted(kb, ka, "right") - starts
+    if mask is not None:
+        counts[~mask] = 0
+    total = counts.sum()
+    i = np.repeat(np.arange(len(ka)), counts)
+    offsets = np.repeat(starts - (np.cumsum(counts) - counts), counts)
+    j = order[offsets + np.arange(total)]
+    return i, j
+
+
+class SortedIndex():
+    '''
+    The rows of a relation that pass the constant and repeated variable
+    filters of an atom, with their keys over some columns kept sorted.
+    Relations only grow by appending rows, which update() merges in, so
+    a join sorts just the rows added since the previous one.
+    '''
+
+    def __init__(self, arity, consts, repeats, cols):
+        # (column, value) and (column, column) filters
+        self.consts = consts
+        self.repeats = repeats
+        self.cols = list(cols)
+        # number of rows of the relation seen so far
+        self.size = 0
+        self.rows = empty(arity)
+        self.keys = np.zeros(0, dtype=np.int64)
+        self.order = np.zeros(0, dtype=np.int64)
+        # column ranges of the mixed radix keys, None if they overflow an int64
+        self.lo = np.zeros(len(cols), dtype=np.int64)
+        self.hi = np.full(len(cols), -1, dtype=np.int64)
+
+    def key(self, rows):
+        '''Keys of rows over the key columns and the mask of rows inside the key ranges'''
+        if len(self.cols) == 1:
+            return rows[:, 0], None
+        inside = ((rows >= self.lo) & (rows <= self.hi)).all(axis=1)
+        if not inside.all():
+            rows = np.clip(rows, self.lo, self.hi)
+        key = np.zeros(len(rows), dtype=np.int64)
+        for col, l, h in zip(rows.T, self.lo, self.hi):
+            key = key * (h - l + 1) + (col - l)
+        return key, inside
+
+    def update(self, data):
+        '''Merges in the rows appended to the relation data since the previous call'''
+        if len(data) == self.size:
+            return
+        rows = data[self.size:]
+        mask = np.ones(len(rows), dtype=bool)
+        for i, c in self.consts:
+            mask &= rows[:, i] == c
+        for i, j in self.repeats:
+            mask &= rows[:, i] == rows[:, j]
+        rows = rows[mask]
+        self.size = len(data)
+        if len(rows) == 0:
+            return
+        start = len(self.rows)
+        self.rows = np.concatenate([self.rows, rows])
+        if self.lo is None:
+            return
+        if len(self.cols) > 1:
+            lo, hi = rows[:, self.cols].min(axis=0), rows[:, self.cols].max(axis=0)
+            if start > 0:
+                lo, hi = np.minimum(self.lo, lo), np.maximum(self.hi, hi)
+            if (lo != self.lo).any() or (hi != self.hi).any():
+                # new key ranges, so rebuild
+                if np.prod((hi - lo + 1).astype(float)) >= 2 ** 62:
+                    self.lo = self.hi = None
+                    return
+                self.lo, self.hi = lo, hi
+                start, rows = 0, self.rows
+                self.keys = self.keys[:0]
+                self.order = self.order[:0]
+        key, _ = self.key(rows[:, self.cols])
+        order = np.argsort(key, kind="stable")
+        key = key[order]
+        pos = np.searchsorted(self.keys, key, "right")
+        self.keys = np.insert(self.keys, pos, key)
+        self.order = np.insert(self.order, pos, start + order)
+
+    def join(self, a):
+        '''Index arrays (i, j) of all pairs with a[i] equal to the key columns of rows[j]'''
+        if self.lo is None:
+            return join_indices(a, self.rows[:, self.cols])
+        ka, inside = self.key(a)
+        return merge_indices(ka, self.keys, self.order, inside)
+
+    def contains(self, a):
+        '''Mask of the rows of a whose key occurs in the index'''
+        if self.lo is None or len(self.keys) == 0:
+            mask = np.zeros(len(a), dtype=bool)
+            mask[self.join(a)[0]] = True
+            return mask
+        ka, inside = self.key(a)
+        pos = np.minimum(np.searchsorted(self.keys, ka), len(self.keys) - 1)
+        mask = self.keys[pos] == ka
+        return mask if inside is None else mask & inside
+
+
+class Bindings():
+    '''Columnar table of variable bindings, one array per variable'''
+
+    def __init__(self, size=1):
+        self.size = size
+        self.cols = {}
+
+    def take(self, idx):
+        res = Bindings(len(idx))
+        res.cols = {v: col[idx] for v, col in self.cols.items()}
+        return res
+
+
+class Cursor():
+    '''
+    Minimal stand in for a sqlite3 cursor.
+    Only supports SELECT * FROM relation.
+    '''
+
+    def __init__(self, solver):
+        self.solver = solver
+        self.rows = []
+
+    def execute(self, stmt, *args):
+        m = re.fullmatch(r"\s*SELECT\s+\*\s+FROM\s+(\w+)\s*;?\s*",
+                         stmt, re.IGNORECASE)
+        if m is None:
+            raise Exception(f"NumpySolver cursor can not execute {stmt}")
+        self.rows = self.solver.tuples(m[1])
+        return self
+
+    def fetchall(self):
+        rows, self.rows = self.rows, []
+        return rows
+
+    def fetchone(self):
+        if len(self.rows) == 0:
+            return None
+        return self.rows.pop(0)
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+
+class NumpySolver(BaseSolver):
+    '''
+    Pure python / numpy datalog solver.
+    Supports atoms with variables and constants, Eq and negated atoms in bodies.
+    '''
+
+    def __init__(self):
+        self.rules = []
+        self.rels = {}
+        self.data = {}
+        # SortedIndex per (relation, constant filters, repeat filters, key columns)
+        self.indexes = {}
+        self.facts = defaultdict(list)
+        self.symbols = {}
+        self.names = []
+        self.cur = Cursor(self)
+
+    def intern(self, x):
+        if isinstance(x, str):
+            id_ = self.symbols.get(x)
+            if id_ is None:
+                id_ = len(self.names)
+                self.symbols[x] = id_
+                self.names.append(x)
+            return id_
+        elif isinstance(x, (int, np.integer)):
+            return int(x)
+        else:
+            raise Exception(f"NumpySolver: unsupported value {x}")
+
+    def Relation(self, name: str, *types):
+        types = [conv_type(typ) for typ in types]
+        if name not in self.rels:
+            self.rels[name] = types
+            self.data[name] = empty(len(types))
+        else:
+            assert self.rels[name] == types
+        return lambda *args: Atom(name, args)
+
+    def add_fact(self, fact: Atom):
+        assert all([not isinstance(arg, Var) for arg in fact.args])
+        self.facts[fact.name].append([self.intern(arg) for arg in fact.args])
+
+    def load(self, name: str, rows):
+        '''Loads an iterable of tuples or a 2d integer array'''
+        rows = np.asarray([[self.intern(x) for x in row] for row in rows], dtype=np.int64) \
+            if not isinstance(rows, np.ndarray) else rows.astype(np.int64)
+        self.facts[name] += rows.reshape(-1, len(self.rels[name])).tolist()
+
+    def tuples(self, name):
+        types = self.rels[name]
+        return [tuple([self.names[x] if typ == TEXT else x for x, typ in zip(row, types)])
+                for row in self.data[name].tolist()]
+
+    def index(self, name, cols, consts=(), repeats=()):
+        '''The SortedIndex of relation name over cols, brought up to date'''
+        key = (name, consts, repeats, cols)
+        idx = self.indexes.get(key)
+        if idx is None:
+            idx = self.indexes[key] = SortedIndex(
+                len(self.rels[name]), consts, repeats, cols)
+        idx.update(self.data[name])
+        return idx
+
+    def stratify(self):
+        G = nx.DiGraph()
+        G.add_nodes_from(self.rels)
+        for head, body in self.rules:
+            G.add_edge(head.name, head.name)
+            for rel in body:
+                if isinstance(rel, Atom):
+                    G.add_edge(rel.name, head.name)
+                elif isinstance(rel, Not):
+                    G.add_edge(rel.val.name, head.name)
+        scc = list(nx.strongly_connected_components(G))
+        cond = nx.condensation(G, scc=scc)
+        for n in nx.topological_sort(cond):
+            yield scc[n]
+
+    def eval_body(self, head, body, delta_index, deltas):
+        '''
+        Evaluates a rule body into the rows of head.
+        Atom number delta_index (if not None) reads from deltas.
+        '''
+        # Var = Var constraints are resolved by renaming.
+        # Variables are keyed by name since Var.__eq__ builds an Eq
+        rep = {}
+
+        def find(x):
+            x = x.name
+            while x in rep:
+                x = rep[x]
+            return x
+        for rel in body:
+            if isinstance(rel, Eq) and isinstance(rel.lhs, Var) and isinstance(rel.rhs, Var):
+                if find(rel.lhs) != find(rel.rhs):
+                    rep[find(rel.lhs)] = find(rel.rhs)
+        atoms = [(n, rel) for n, rel in enumerate(
+            [rel for rel in body if isinstance(rel, Atom)])]
+        # delta first, then atoms sharing variables with what is bound
+        order = []
+        bound = set()
+        while len(atoms) > 0:
+            if len(order) == 0 and delta_index is not None:
+                pick = [a for a in atoms if a[0] == delta_index][0]
+            else:
+                pick = max(atoms, key=lambda a: len(
+                    {find(v) for v in a[1].args if isinstance(v, Var)} & bound))
+            atoms.remove(pick)
+            order.append(pick)
+            bound.update([find(v) for v in pick[1].args if isinstance(v, Var)])
+        b = Bindings()
+        for n, atom in order:
+            # constants and repeated variables within the atom
+            consts = []
+            repeats = []
+            cols = {}
+            for i, arg in enumerate(atom.args):
+                if isinstance(arg, Var):
+                    v = find(arg)
+                    if v in cols:
+                        repeats.append((i, cols[v]))
+                    else:
+                        cols[v] = i
+                else:
+                    consts.append((i, self.intern(arg)))
+            shared = [v for v in cols if v in b.cols]
+            keys = np.stack([b.cols[v] for v in shared], axis=1) if shared else np.zeros((b.size, 0), dtype=np.int64)
+            if n == delta_index:
+                rows = deltas[atom.name]
+                mask = np.ones(len(rows), dtype=bool)
+                for i, c in consts:
+                    mask &= rows[:, i] == c
+                for i, j in repeats:
+                    mask &= rows[:, i] == rows[:, j]
+                rows = rows[mask]
+                i, j = join_indices(keys, rows[:, [cols[v] for v in shared]])
+            else:
+                idx = self.index(atom.name, tuple(cols[v] for v in shared),
+                                 tuple(consts), tuple(repeats))
+                rows = idx.rows
+                i, j = idx.join(keys)
+            b = b.take(i)
+            for v, c in cols.items():
+                if v not in b.cols:
+                    b.cols[v] = rows[j, c]
+        for rel in body:
+            if isinstance(rel, Eq) and isinstance(rel.lhs, Var) != isinstance(rel.rhs, Var):
+                v, c = (rel.lhs, rel.rhs) if isinstance(
+                    rel.lhs, Var) else (rel.rhs, rel.lhs)
+                v = find(v)
+                if v in b.cols:
+                    b = b.take(np.nonzero(b.cols[v] == self.intern(c))[0])
+                else:
+                    b.cols[v] = np.full(b.size, self.intern(c), dtype=np.int64)
+            elif not isinstance(rel, (Atom, Eq, Not)):
+                raise Exception(f"NumpySolver: unsupported body formula {rel}")
+        for rel in body:
+            if isinstance(rel, Not):
+                atom = rel.val
+                keys = np.stack([b.cols[find(arg)] if isinstance(arg, Var) else np.full(b.size, self.intern(arg), dtype=np.int64)
+                                 for arg in atom.args], axis=1).reshape(b.size, len(atom.args))
+                b = b.take(np.nonzero(~self.all_columns(atom.name).contains(keys))[0])
+        cols = [b.cols[find(arg)] if isinstance(arg, Var) else np.full(b.size, self.intern(arg), dtype=np.int64)
+                for arg in head.args]
+        return np.stack(cols, axis=1).reshape(b.size, len(head.args))
+
+    def all_columns(self, name):
+        return self.index(name, tuple(range(len(self.rels[name]))))
+
+    def run(self):
+        for name, rows in self.facts.items():
+            rows = unique_rows(np.asarray(rows, dtype=np.int64).reshape(-1,
+                                                                        len(self.rels[name])))
+            # appended, so the sorted indexes stay valid
+            self.data[name] = np.concatenate(
+                [self.data[name], rows[~self.all_columns(name).contains(rows)]])
+        self.facts.clear()
+        for strata in self.stratify():
+            new = defaultdict(list)
+            recursive = []
+            for head, body in self.rules:
+                if head.name not in strata:
+                    continue
+                atoms = [rel for rel in body if isinstance(rel, Atom)]
+                if any([rel.name in strata for rel in atoms]):
+                    recursive += [(head, body, n)
+                                  for n, rel in enumerate(atoms) if rel.name in strata]
+                else:
+                    new[head.name].append(self.eval_body(head, body, None, {}))
+            # The current contents are the initial delta
+            deltas = dict(
+                {name: self.data[name] for name in strata})
+            while True:
+                for name in strata:
+                    if len(new[name]) > 0:
+                        rows = unique_rows(np.concatenate(new[name]))
+                        rows = rows[~self.all_columns(name).contains(rows)]
+                        # distinct from each other and from deltas, a subset of data
+                        deltas[name] = np.concatenate([deltas[name], rows])
+                        self.data[name] = np.concatenate(
+                            [self.data[name], rows])
+                if all([len(deltas[name]) == 0 for name in strata]):
+                    break
+                new = defaultdict(list)
+                for head, body, n in recursive:
+                    new[head.name].append(
+                        self.eval_body(head, body, n, deltas))
+                deltas = {name: empty(len(self.rels[name]))
+                          for name in strata}
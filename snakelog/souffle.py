@@ -4,6 +4,10 @@ import sqlite3
 import tempfile
 from .common import *
 import csv
+import hashlib
+import os
+import shutil
+from collections import defaultdict
 from pathlib import Path
 NUMBER = "number"
 SYMBOL = "symbol"
@@ -18,6 +22,35 @@ def conv_type(typ):
         return typ
 
 
+# souffle writes relations of plain columns here, see SouffleSolver.program
+output_sqlite = "snakelog_output.sqlite"
+
+
+def sqlite_type(typ):
+    '''Column affinity converting souffle csv output'''
+    return "INTEGER" if conv_type(typ) == NUMBER else "TEXT"
+
+
+def plain(types):
+    '''Relations of numbers and symbols can use souffle's sqlite output'''
+    return all([conv_type(typ) in [NUMBER, SYMBOL] for typ in types])
+
+
+def default_cache_dir():
+    return Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache")) / "snakelog" / "souffle"
+
+
+# souffle --version output per executable
+versions = {}
+
+
+def souffle_version(execname):
+    if execname not in versions:
+        res = subprocess.run([execname, "--version"], capture_output=True)
+        versions[execname] = res.stdout.decode()
+    return versions[execname]
+
+
 def from_str(data, typ):
     if typ == NUMBER or typ == Sort.NUMBER:
         return int(data)
@@ -26,10 +59,19 @@ def from_str(data, typ):
 
 
 class SouffleSolver(BaseSolver):
-    def __init__(self, output_db=":memory:", input_db=None, execname="souffle", compiled=False):
+    def __init__(self, output_db=":memory:", input_db=None, execname="souffle", compiled=False, cache_dir=None):
+        '''
+        compiled=True compiles the program with souffle -o. Executables are cached
+        in cache_dir keyed by the program text and souffle version, so reruns
+        with different facts skip the C++ compile.
+        '''
         self.execname = execname
         self.options = {"compiled": compiled}
+        self.cache_dir = Path(
+            cache_dir) if cache_dir != None else default_cache_dir()
         self.rules = []
+        # ground facts, passed to souffle in .facts files
+        self.facts = defaultdict(list)
         self.rels = []
         self.funs = []
         self.output_db = output_db
@@ -43,11 +85,22 @@ class SouffleSolver(BaseSolver):
 
     def Relation(self, name, *types):
         self.rels.append((name, types))
-        args = ", ".join([f"x{n}" for n in range(len(types))])
+        args = ", ".join([f"x{n} {sqlite_type(typ)}" for n, typ in enumerate(types)])
+        bareargs = ", ".join([f"x{n}" for n in range(len(types))])
         self.cur.execute(
-            f"CREATE TABLE {name}({args}, PRIMARY KEY ({args})) WITHOUT ROWID")
+            f"CREATE TABLE {name}({args}, PRIMARY KEY ({bareargs})) WITHOUT ROWID")
         return lambda *args: Atom(name, args)
 
+    def load(self, name, rows):
+        '''Bulk adds an iterable of tuples of numbers and strings to relation name'''
+        self.facts[name].extend(rows)
+
+    def add_fact(self, fact: Atom):
+        if all([isinstance(arg, (int, str)) for arg in fact.args]):
+            self.facts[fact.name].append(fact.args)
+        else:
+            self.add_rule(fact, [])
+
     def compile(self, head: Atom, body):
         def arg_str(x):
             if isinstance(x, Var):
@@ -69,19 +122,25 @@ class SouffleSolver(BaseSolver):
             body = ", ".join(map(rel_str, body))
             return f"{rel_str(head)} :- {body}."
 
-    def run(self):
+    def program(self):
+        '''Datalog text of the program. It does not depend on the facts.'''
         stmts = []
         for name, types in self.rels:
             args = ", ".join(
                 [f"x{n} : {conv_type(typ)}" for n, typ in enumerate(types)])
             stmts.append(f".decl {name}({args})")
+            stmts.append(
+                f".input {name}(IO=file, filename=\"{name}.facts\", rfc4180=true)")
             if self.input_db != None:
                 stmts.append(
                     f".input {name}(IO=sqlite, filename=\"{self.input_db}\")")
-            # stmts.append(
-            #    f".output {name}(IO=file, filename=\"{self.output_db}\")")
-            stmts.append(
-                f".output {name}(IO=file, rfc4180=true)")
+            if plain(types):
+                stmts.append(
+                    f".output {name}(IO=sqlite, dbname=\"{output_sqlite}\")")
+            else:
+                # The souffle sqlite output for records is no good.
+                stmts.append(
+                    f".output {name}(IO=file, rfc4180=true)")
         if len(self.funs) != 0:
             constructors = []
             for name, types in self.funs:
@@ -92,21 +151,75 @@ class SouffleSolver(BaseSolver):
             stmts.append(f".type term = {constructors}")
         for head, body in self.rules:
             stmts.append(self.compile(head, body))
+        return "\n".join(stmts) + "\n"
+
+    def executable(self, program):
+        '''Compiled executable of program, built with souffle -o on a cache miss'''
+        key = hashlib.sha256(
+            (souffle_version(self.execname) + program).encode()).hexdigest()
+        exe = self.cache_dir / key
+        if exe.exists():
+            return exe
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
         with tempfile.TemporaryDirectory() as tmpdirname:
-            with tempfile.NamedTemporaryFile(suffix=".dl", dir=tmpdirname) as fp:
-                fp.writelines([stmt.encode() + b"\n" for stmt in stmts])
-                fp.flush()
-                res = subprocess.run(
-                    [self.execname, fp.name, "-D", tmpdirname], capture_output=True)
-                print(res.stdout.decode())
-                print(res.stderr.decode())
-                # The souffle sqlite output for records is no good.
-                # It would be much preferable to use it for speed and simplicity rather than csv
-                for name, types in self.rels:
-                    with open(Path(tmpdirname) / f'{name}.csv') as f:
-                        reader = csv.reader(f)
-                        data = [[from_str(data, typ) for data, typ in zip(
-                            row, types)] for row in reader]
-                        args = ", ".join("?" * len(types))
-                        self.cur.executemany(
-                            f"INSERT OR IGNORE INTO {name} VALUES ({args});", data)
+            dl = Path(tmpdirname) / "prog.dl"
+            dl.write_text(program)
+            out = Path(tmpdirname) / "prog"
+            res = subprocess.run(
+                [self.execname, str(dl), "-o", str(out)], capture_output=True, cwd=tmpdirname)
+            print(res.stdout.decode())
+            print(res.stderr.decode())
+            if res.returncode != 0:
+                raise Exception(f"souffle compilation failed {res.stderr.decode()}")
+            # atomic, concurrent compiles of the same program race harmlessly
+            tmp = self.cache_dir / f"{key}.{os.getpid()}.tmp"
+            shutil.copy2(out, tmp)
+            os.replace(tmp, exe)
+        return exe
+
+    def run(self):
+        program = self.program()
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            for name, types in self.rels:
+                with open(Path(tmpdirname) / f"{name}.facts", "w", newline="") as f:
+                    csv.writer(f, delimiter="\t", lineterminator="\n").writerows(
+                        self.facts[name])
+            if self.options["compiled"]:
+                cmd = [str(self.executable(program))]
+            else:
+                dl = Path(tmpdirname) / "prog.dl"
+                dl.write_text(program)
+                cmd = [self.execname, str(dl)]
+            res = subprocess.run(
+                cmd + ["-F", tmpdirname, "-D", tmpdirname], capture_output=True, cwd=tmpdirname)
+            print(res.stdout.decode())
+            print(res.stderr.decode())
+            if res.returncode != 0:
+                raise Exception(f"souffle failed {res.stderr.decode()}")
+            self.read_outputs(Path(tmpdirname))
+
+    def read_outputs(self, outdir):
+        '''
+        Copies the souffle outputs in outdir into the sqlite tables.
+        Relations of plain columns are copied by SQL from the souffle sqlite output.
+        Others are streamed from csv, with the column affinity converting numbers.
+        '''
+        self.con.commit()
+        if any([plain(types) for name, types in self.rels]):
+            self.cur.execute("ATTACH DATABASE ? AS souffle",
+                             (str(outdir / output_sqlite),))
+            tables = {name for name, in self.cur.execute(
+                "SELECT name FROM souffle.sqlite_master")}
+        for name, types in self.rels:
+            if plain(types):
+                if name in tables:
+                    self.cur.execute(
+                        f"INSERT OR IGNORE INTO main.{name} SELECT * FROM souffle.{name}")
+            else:
+                with open(outdir / f'{name}.csv', newline="") as f:
+                    args = ", ".join("?" * len(types))
+                    self.cur.executemany(
+                        f"INSERT OR IGNORE INTO {name} VALUES ({args});", csv.reader(f))
+        self.con.commit()
+        if any([plain(types) for name, types in self.rels]):
+            self.cur.execute("DETACH DATABASE souffle")
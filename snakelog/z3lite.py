@@ -1,17 +1,141 @@
 from z3 import *
 import sqlite3
 import operator
+import threading
+import weakref
+from itertools import count
+from collections import OrderedDict, defaultdict
+
+# declared column types holding z3 expressions
+z3_types = ["AstRef", "BoolRef", "ArithRef",
+            "BitVecRef", "CharRef", "DatatypeRef"]
+
+
+# store ids are unique over all stores, so an id always decodes to the
+# expression it was given to
+ids = count()
+# store id -> the store holding it
+owners = weakref.WeakValueDictionary()
+
+
+class Z3Store():
+    '''
+    Table between the integer ids stored in SQLite and z3 expressions.
+    Expressions are interned: z3 hash conses terms, so structurally equal
+    expressions kept alive by the store have the same ast id and share a store id.
+    Ids no longer referenced by any row can be reclaimed with collect, and ids
+    unused for a number of generations with evict.
+    '''
+
+    def __init__(self):
+        self.asts = {}
+        # (context, z3 ast id) -> store id
+        self.ids = {}
+        # store id -> generation of last use
+        self.used = {}
+        self.generation = 0
+        # parallel strata intern concurrently
+        self.lock = threading.Lock()
+
+    def key(self, x: AstRef):
+        return id(x.ctx), x.get_id()
+
+    def get_id(self, x: AstRef):
+        key = self.key(x)
+        with self.lock:
+            id_ = self.ids.get(key)
+            if id_ is None:
+                id_ = next(ids)
+                self.asts[id_] = x
+                self.ids[key] = id_
+                owners[id_] = self
+            self.used[id_] = self.generation
+        return id_
+
+    def lookup_id(self, id_):
+        id_ = int(id_)
+        x = self.asts.get(id_)
+        if x is None:
+            raise KeyError(f"z3 expression {id_} is not in the store")
+        self.used[id_] = self.generation
+        return x
+
+    def remove(self, id_):
+        del self.ids[self.key(self.asts.pop(id_))]
+        del self.used[id_]
+        owners.pop(id_, None)
+
+    def live_ids(self, con):
+        '''Ids held by a column of z3 type in a table of con'''
+        live = set()
+        tables = con.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' UNION ALL SELECT name FROM sqlite_temp_master WHERE type = 'table'").fetchall()
+        for table, in tables:
+            for _, col, typ, *_ in con.execute(f"PRAGMA table_info({table})").fetchall():
+                if typ.split(" ")[0].lower() in [t.lower() for t in z3_types]:
+                    # CAST skips the converter
+                    live.update([id_ for id_, in con.execute(
+                        f"SELECT DISTINCT CAST({col} AS INTEGER) FROM {table}")])
+        return live
+
+    def collect(self, *cons):
+        '''
+        Removes the expressions not referenced by any row of the connections.
+        Must not run while a statement that creates expressions is in progress.
+        Returns the number of removed expressions.
+        '''
+        live = set()
+        for con in cons:
+            live |= self.live_ids(con)
+        dead = [id_ for id_ in self.asts if id_ not in live]
+        for id_ in dead:
+            self.remove(id_)
+        return len(dead)
+
+    def next_generation(self):
+        self.generation += 1
+
+    def evict(self, keep=1):
+        '''Removes the expressions not used in the last keep generations'''
+        dead = [id_ for id_, gen in self.used.items()
+                if gen <= self.generation - keep]
+        for id_ in dead:
+            self.remove(id_)
+        return len(dead)
+
+    def __len__(self):
+        return len(self.asts)
+
+    def __enter__(self):
+        global store
+        self.previous = store
+        store = self
+        return self
+
+    def __exit__(self, *args):
+        global store
+        store = self.previous
+
+
+'''
+The active store, used by the process wide sqlite3 adapters, so by connections
+without a store of their own from enable_z3. A with block activates a store.
+The converters decode every id with the store holding it.
+'''
+default_store = Z3Store()
+store = default_store
+z3_ast_table = default_store.asts
 
-z3_ast_table = {}
 
 def get_id(x: AstRef):
-    id_ = x.get_id()
-    z3_ast_table[id_] = x
-    return id_
+    return store.get_id(x)
 
 
 def lookup_id(id_: bytes):
-    return z3_ast_table[int(id_)]
+    owner = owners.get(int(id_))
+    if owner is None:
+        raise KeyError(f"z3 expression {int(id_)} is not in any store")
+    return owner.lookup_id(id_)
 
 
 sqlite3.register_adapter(AstRef, get_id)
@@ -34,22 +158,150 @@ sqlite3.register_converter("CharRef", lookup_id)
 sqlite3.register_converter("DatatypeRef", lookup_id)
 
 
-def check_sat(e: bytes):
-    s = Solver()
-    s.add(lookup_id(e))
-    res = s.check()
-    return repr(res)
+class LRU():
+    '''Least recently used cache counting hits and misses in stats'''
+
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.stats = defaultdict(int)
+
+    def lookup(self, key):
+        res = self.data.get(key)
+        if res is None:
+            self.stats["misses"] += 1
+        else:
+            self.stats["hits"] += 1
+            self.data.move_to_end(key)
+        return res
+
+    def put(self, key, value):
+        self.data[key] = value
+        if len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def get(self, key, make):
+        res = self.lookup(key)
+        if res is None:
+            res = make()
+            self.put(key, res)
+        return res
+
+    def hit_rate(self):
+        total = self.stats["hits"] + self.stats["misses"]
+        return self.stats["hits"] / total if total > 0 else 0.0
+
+
+def ast_key(x: AstRef):
+    return id(x.ctx), x.get_id()
+
+
+def conjuncts(e: BoolRef):
+    if is_and(e):
+        return [c for arg in e.children() for c in conjuncts(arg)]
+    return [e]
+
+
+class SatChecker():
+    '''
+    Memoized satisfiability checks.
+    Results are cached by the z3 ast id of the simplified formula, which is
+    kept alive by the cache so the id is not reused. unknown is not cached.
+    With incremental=True one solver is reused: the conjuncts of a formula are
+    asserted in their own scopes and only the scopes after the prefix shared
+    with the previous formula are popped. timeout is in milliseconds.
+    '''
+
+    def __init__(self, maxsize=4096, incremental=False, timeout=None):
+        self.cache = LRU(maxsize)
+        self.stats = self.cache.stats
+        self.incremental = incremental
+        self.timeout = timeout
+        self.solver = None
+        # conjuncts asserted in the scopes of self.solver
+        self.stack = []
+
+    def make_solver(self):
+        s = Solver()
+        if self.timeout is not None:
+            s.set("timeout", self.timeout)
+        return s
+
+    def solve(self, e):
+        self.stats["checks"] += 1
+        if not self.incremental:
+            s = self.make_solver()
+            s.add(e)
+            return s.check()
+        if self.solver is None:
+            self.solver = self.make_solver()
+        cs = conjuncts(e)
+        n = 0
+        while n < min(len(cs), len(self.stack)) and self.stack[n].eq(cs[n]):
+            n += 1
+        if len(self.stack) > n:
+            self.stats["pops"] += len(self.stack) - n
+            self.solver.pop(len(self.stack) - n)
+            self.stack = self.stack[:n]
+        for c in cs[n:]:
+            self.solver.push()
+            self.solver.add(c)
+            self.stack.append(c)
+        self.stats["pushes"] += len(cs) - n
+        return self.solver.check()
+
+    def check(self, e: BoolRef):
+        e = simplify(e)
+        key = ast_key(e)
+        res = self.cache.lookup(key)
+        if res is not None:
+            return res[1]
+        res = repr(self.solve(e))
+        if res == "unknown":
+            self.stats["unknown"] += 1
+        else:
+            self.cache.put(key, (e, res))
+        return res
+
+    def hit_rate(self):
+        return self.cache.hit_rate()
+
+
+sat_checker = SatChecker()
+
+
+def check_sat(e: bytes, checker=None):
+    e = lookup_id(e)
+    return (sat_checker if checker is None else checker).check(e)
+
 
+def enable_z3(con, ast_store=None, checker=None, cache_size=4096):
+    '''
+    Registers the z3 functions on con. They put their results in ast_store if
+    given, otherwise in the store active when they are called. If con is the
+    connection of a litelog Solver, the z3 values the solver writes through it
+    also go to ast_store, regardless of the active store. check_sat uses
+    checker, by default the module sat_checker. The simplified results of the
+    other functions are memoized in an LRU of cache_size entries, returned.
+    '''
+    def get_store():
+        return store if ast_store is None else ast_store
+    if ast_store is not None and hasattr(con, "adapters"):
+        con.adapters[AstRef] = ast_store.get_id
+    # keyed on function name and argument ast ids, holding arguments and result
+    memo = LRU(cache_size)
 
-def enable_z3(con):
     def create_z3_2(name, f):
         def wrapf(x, y):
-            return get_id(simplify(f(lookup_id(x), lookup_id(y))))
+            x, y = lookup_id(x), lookup_id(y)
+            return get_store().get_id(memo.get((name, ast_key(x), ast_key(y)),
+                                      lambda: (x, y, simplify(f(x, y))))[2])
         con.create_function(name, 2, wrapf, deterministic=True)
 
     def create_z3_1(name, f):
         def wrapf(x):
-            return get_id(simplify(f(lookup_id(x))))
+            x = lookup_id(x)
+            return get_store().get_id(memo.get((name, ast_key(x)), lambda: (x, simplify(f(x))))[1])
         con.create_function(name, 1, wrapf, deterministic=True)
     # I could possibly do this as an .so sqlite extension instead.
     create_z3_2("z3_and", And)
@@ -72,6 +324,7 @@ def enable_z3(con):
     create_z3_1("z3_neg", operator.neg)
     create_z3_1("z3_not", Not)
 
-    con.create_function("check_sat", 1, check_sat, deterministic=True)
+    con.create_function("check_sat", 1, lambda e: check_sat(e, checker), deterministic=True)
+    return memo
     # con.create_function("z3_and", 2, lambda x, y:
     #                    get_id(simplify(And(lookup_id(x), lookup_id(y)))), deterministic=True)
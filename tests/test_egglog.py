@@ -1,9 +1,33 @@
 from snakelog.common import *
 from snakelog.egglog import *
 from .progs import progs
+import time
 
 
 def test_progs():
     for prog in progs:
         s = EgglogSolver()
         prog(s)
+
+
+def test_persistent():
+    s = EgglogSolver(persistent=True, timeout=60)
+    edge = s.Relation("edge", Sort.NUMBER, Sort.NUMBER)
+    path = s.Relation("path", Sort.NUMBER, Sort.NUMBER)
+    x, y, z = Vars("x y z")
+    s.add(edge(1, 2))
+    s.add(path(x, y) <= edge(x, y))
+    s.add(path(x, z) <= edge(x, y) & path(y, z))
+    s.run(iterations=None, outputs=["path"])
+    assert set(s.cur.execute("SELECT * FROM path").fetchall()) == {(1, 2)}
+    s.add(edge(2, 3))
+    s.run(iterations=None, outputs=["path"])
+    assert set(s.cur.execute("SELECT * FROM path").fetchall()) == {
+        (1, 2), (2, 3), (1, 3)}
+    # a time budget stops at saturation
+    s.add(edge(3, 4))
+    start = time.time()
+    s.run(iterations=None, timeout=30, outputs=["path"])
+    assert time.time() - start < 30
+    assert len(s.cur.execute("SELECT * FROM path").fetchall()) == 6
+    s.close()
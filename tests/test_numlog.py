@@ -0,0 +1,49 @@
+from snakelog.common import *
+from snakelog.numlog import *
+from snakelog.litelog import Solver
+from .progs import progs
+
+
+def test_progs():
+    for prog in progs:
+        prog(NumpySolver())
+
+
+def test_against_litelog():
+    def prog(s):
+        edge = s.Relation("edge", Sort.SYMBOL, Sort.SYMBOL)
+        path = s.Relation("path", Sort.SYMBOL, Sort.SYMBOL)
+        loop = s.Relation("loop", Sort.SYMBOL)
+        noloop = s.Relation("noloop", Sort.SYMBOL)
+        x, y, z = Vars("x y z")
+        for i in range(20):
+            s.add(edge(f"n{i}", f"n{(i * 7) % 13}"))
+        s.add(path(x, y) <= edge(x, y))
+        s.add(path(x, z) <= path(x, y) & path(y, z))
+        s.add(loop(x) <= path(x, y) & (x == y))
+        s.add(noloop(x) <= edge(x, y) & Not(loop(x)))
+        s.add(loop("n0") <= edge("n0", y))
+        s.run()
+        res = {}
+        for rel in ["path", "loop", "noloop"]:
+            s.cur.execute(f"SELECT * FROM {rel}")
+            res[rel] = set(s.cur.fetchall())
+        return res
+    assert prog(NumpySolver()) == prog(Solver())
+
+
+def test_rerun():
+    s = NumpySolver()
+    edge = s.Relation("edge", Sort.NUMBER, Sort.NUMBER)
+    path = s.Relation("path", Sort.NUMBER, Sort.NUMBER)
+    x, y, z = Vars("x y z")
+    s.add(path(x, y) <= edge(x, y))
+    s.add(path(x, z) <= edge(x, y) & path(y, z))
+    s.load("edge", [(i, i + 1) for i in range(10)])
+    s.run()
+    # facts added later are merged into the indexes built by the first run
+    s.load("edge", [(10, 11), (3, 4), (2 ** 40, 0)])
+    s.run()
+    s.cur.execute("SELECT * FROM path")
+    assert set(s.cur.fetchall()) == {(i, j) for i in range(12) for j in range(i + 1, 12)} | \
+        {(2 ** 40, j) for j in range(12)}
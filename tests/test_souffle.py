@@ -38,3 +38,56 @@ def test_list():
     res = s.con.execute("SELECT * FROM lists")
     assert set(res.fetchall()) == {
         ("$Cons(1, $Cons(2, $Nil))",), ("$Cons(2, $Nil)",), ("$Nil",)}
+
+
+def test_program_excludes_facts():
+    def prog(facts):
+        s = SouffleSolver()
+        edge = s.Relation("edge", "number", "number")
+        path = s.Relation("path", "number", "number")
+        x, y, z = Vars("x y z")
+        for fact in facts:
+            s.add(edge(*fact))
+        s.add(path(x, y) <= edge(x, y))
+        return s.program()
+    assert prog([(1, 2)]) == prog([(3, 4), (5, 6)])
+
+
+def test_compiled_cache(tmp_path):
+    def prog(facts):
+        s = SouffleSolver(compiled=True, cache_dir=tmp_path)
+        edge = s.Relation("edge", "number", "number")
+        path = s.Relation("path", "number", "number")
+        x, y, z = Vars("x y z")
+        for fact in facts:
+            s.add(edge(*fact))
+        s.add(path(x, y) <= edge(x, y))
+        s.add(path(x, z) <= edge(x, y) & path(y, z))
+        s.run()
+        return set(s.cur.execute("SELECT * FROM path").fetchall())
+    assert prog([(1, 2), (2, 3)]) == {(1, 2), (2, 3), (1, 3)}
+    assert prog([(4, 5)]) == {(4, 5)}
+    assert len(list(tmp_path.iterdir())) == 1
+
+
+def test_read_outputs(tmp_path):
+    s = SouffleSolver()
+    s.Relation("path", "number", "symbol")
+    s.Relation("empty", "number")
+    s.Relation("lists", "term", "number")
+    # what souffle leaves in its output directory
+    out = sqlite3.connect(tmp_path / "snakelog_output.sqlite")
+    out.execute("CREATE TABLE _path(x0 INTEGER, x1 INTEGER)")
+    out.execute("CREATE TABLE __SymbolTable(id INTEGER PRIMARY KEY, symbol TEXT)")
+    out.execute("INSERT INTO _path VALUES (1, 0), (2, 1)")
+    out.execute("INSERT INTO __SymbolTable VALUES (0, 'a'), (1, 'b')")
+    out.execute(
+        "CREATE VIEW path AS SELECT _path.x0, s.symbol AS x1 FROM _path, __SymbolTable AS s WHERE _path.x1 = s.id")
+    out.commit()
+    out.close()
+    (tmp_path / "lists.csv").write_text('"$Cons(1, $Nil)",3\n$Nil,4\n')
+    s.read_outputs(tmp_path)
+    assert set(s.cur.execute("SELECT * FROM path").fetchall()) == {(1, "a"), (2, "b")}
+    assert set(s.cur.execute("SELECT * FROM lists").fetchall()) == {
+        ("$Cons(1, $Nil)", 3), ("$Nil", 4)}
+    assert s.cur.execute("SELECT * FROM empty").fetchall() == []
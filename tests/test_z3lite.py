@@ -0,0 +1,111 @@
+from snakelog.common import *
+from snakelog.z3lite import *
+from snakelog.litelog import Solver, INTEGER, SQL
+import z3
+
+
+def test_store():
+    st = Z3Store()
+    x = z3.Int("x")
+    assert st.get_id(x + 1) == st.get_id(x + 1)
+    assert st.get_id(x + 2) != st.get_id(x + 1)
+    con = sqlite3.connect(":memory:", detect_types=sqlite3.PARSE_DECLTYPES)
+    con.execute("CREATE TABLE t(e ArithRef)")
+    con.execute("INSERT INTO t VALUES (?)", (st.get_id(x + 1),))
+    assert st.collect(con) == 1
+    assert len(st) == 1 and st.lookup_id(st.get_id(x + 1)).eq(x + 1)
+    st.next_generation()
+    st.next_generation()
+    st.get_id(x + 3)
+    assert st.evict(keep=1) == 1 and len(st) == 1
+
+
+def test_litelog_collect():
+    st = Z3Store()
+    s = Solver()
+    enable_z3(s.con, st)
+    x = z3.Int("x")
+    cond = s.Relation("cond", INTEGER, "BoolRef")
+    path = s.Relation("path", INTEGER, "BoolRef")
+    a, b, c, d = Vars("a b c d")
+    with st:
+        for n in range(10):
+            s.add(cond(n, x > n))
+        s.add_rule(path(a, SQL("z3_and({b}, {c})")), [cond(a, b), cond(d, c), "{d} = {a} + 1"])
+        s.run()
+        res = s.cur.execute("SELECT * FROM path").fetchall()
+    assert len(res) == 9
+    assert all([z3.is_expr(e) for _, e in res])
+    # only the expressions of the 10 cond and 9 path rows survive
+    st.collect(s.con)
+    assert len(st) == 19
+
+
+def test_connection_store():
+    # without a with block, each solver writes to the store of its connection
+    x = z3.Int("x")
+    stores = [Z3Store(), Z3Store()]
+    solvers = []
+    a, b, c = Vars("a b c")
+    for st in stores:
+        s = Solver()
+        enable_z3(s.con, st)
+        cond = s.Relation("cond", INTEGER, "BoolRef")
+        path = s.Relation("path", INTEGER, "BoolRef")
+        s.add(cond(1, x > 1))
+        s.add(cond(2, x < 5))
+        s.add_rule(path(a, SQL("z3_and({b}, {c})")), [cond(a, b), cond(2, c)])
+        solvers.append(s)
+    before = len(default_store)
+    for s in solvers:
+        s.run()
+    for s, st in zip(solvers, stores):
+        res = dict(s.cur.execute("SELECT * FROM path").fetchall())
+        assert res[1].eq(z3.simplify(z3.And(x > 1, x < 5)))
+        assert len(st) == 4
+    assert len(default_store) == before
+
+
+def test_check_sat():
+    x, y = z3.Ints("x y")
+    for incremental in [False, True]:
+        checker = SatChecker(incremental=incremental, timeout=1000)
+        assert checker.check(z3.And(x > 0, x < 5)) == "sat"
+        assert checker.check(z3.And(x < 5, x > 0)) == "sat"
+        assert checker.check(z3.And(x > 0, x < 5)) == "sat"
+        assert checker.check(z3.And(x > 0, x < 5, x > 7)) == "unsat"
+        assert checker.check(z3.And(x > 0, y > x, y < 1)) == "unsat"
+        assert checker.stats["hits"] == 1 and checker.stats["checks"] == 4
+    # the last two formulas share their first conjunct x > 0
+    assert checker.stats["pops"] == 6 and checker.stats["pushes"] == 9
+    st = Z3Store()
+    s = Solver()
+    checker = SatChecker(incremental=True)
+    memo = enable_z3(s.con, st, checker)
+    cond = s.Relation("cond", INTEGER, "BoolRef")
+    path = s.Relation("path", INTEGER, "BoolRef")
+    sat = s.Relation("sat", INTEGER)
+    a, b, c = Vars("a b c")
+    with st:
+        s.add(cond(0, x > 0))
+        s.add(cond(1, x > 0))
+        s.add(cond(2, x < 0))
+        s.add_rule(path(a, SQL("z3_and({b}, {c})")), [cond(a, b), cond(0, c)])
+        s.add_rule(sat(a), [path(a, b), "check_sat({b}) = 'sat'"])
+        s.run()
+    assert set(s.cur.execute("SELECT * FROM sat").fetchall()) == {(0,), (1,)}
+    assert memo.stats["hits"] >= 1 and checker.stats["hits"] >= 1
+
+
+def test_plan_constants():
+    # Int x > 0 and Real x > 0 print the same, but must not share cached parameters
+    n, = Vars("n")
+    for x in [z3.Int("x"), z3.Real("x")]:
+        s = Solver()
+        d = s.Relation("d", INTEGER)
+        c = s.Relation("c", INTEGER, "BoolRef")
+        s.add(d(1))
+        s.add(c(n, x > 0) <= d(n))
+        s.run()
+        (_, e), = s.cur.execute("SELECT * FROM c").fetchall()
+        assert e.eq(x > 0)